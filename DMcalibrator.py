@@ -22,6 +22,10 @@ import math
 import pandas as pd
 from scipy.special import erfinv
 import numpy as np
+import concurrent.futures
+from itertools import repeat
+from MassCache import getMassTable, neutralMass, chargeMZ, massKey, readMassCache, writeMassCache
+from TableIO import readTable, readTableChunks, tableColumns, writeTable, outName, TableWriter
 pd.options.mode.chained_assignment = None  # default='warn'
 
 # os.chdir(r"C:\Users\Andrea\Desktop\SHIFTS-4")
@@ -36,54 +40,46 @@ def readInfile(infile, scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn)
     '''    
     Read input file to dataframe.
     '''
-    df = pd.read_csv(infile, sep="\t", float_precision='high', low_memory=False) # TODO: option for header/no header
-    #df = pd.read_csv(infile, sep="\t", float_precision='high')
-    # Cleanup
-    df = df[df[scorecolumn].notna()]
+    df = readTable(infile) # TODO: option for header/no header
+    df = cleanInfile(df, scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn)
+    return df
+
+def readInfileChunks(infile, chunksize, usecols, scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn):
+    '''
+    Read input file to dataframes of chunksize rows, one at a time.
+    '''
+    for df in readTableChunks(infile, chunksize, usecols):
+        yield cleanInfile(df, scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn)
+
+def cleanInfile(df, scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn):
+    '''
+    Remove rows with missing values and make sure the numeric columns are numbers.
+    '''
+    # Cleanup (rows are removed at once to avoid copying the table several times)
+    #df = df[df[config._sections['Input']['dmcolumn']].notna()]
+    #df[config._sections['Input']['dmcolumn']] = pd.to_numeric(df[config._sections['Input']['dmcolumn']])
+    keep = df[[scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn]].notna().all(axis=1)
+    if not keep.all():
+        df = df[keep]
     df[scorecolumn] = pd.to_numeric(df[scorecolumn])
-    df = df[df[mzcolumn].notna()]
     df[mzcolumn] = pd.to_numeric(df[mzcolumn])
-    df = df[df[zcolumn].notna()]
     df[zcolumn] = pd.to_numeric(df[zcolumn])
-    df = df[df[seqcolumn].notna()]
-    #df = df[df[config._sections['Input']['dmcolumn']].notna()]
-    #df[config._sections['Input']['dmcolumn']] = pd.to_numeric(df[config._sections['Input']['dmcolumn']])
-    df = df[df[proteincolumn].notna()]
     return df
 
-def getTheoMZ(df, mzcolumn, zcolumn, seqcolumn):
+def getTheoMZ(df, mzcolumn, zcolumn, seqcolumn, mass_cache):
     '''    
     Calculate theoretical MZ using the PSM sequence.
     '''
-    AAs = dict(mass_config._sections['Aminoacids'])
-    MODs = dict(mass_config._sections['Fixed Modifications'])
+    mass_table, term_mass = getMassTable(mass_config)
     m_proton = mass_config.getfloat('Masses', 'm_proton')
-    m_hydrogen = mass_config.getfloat('Masses', 'm_hydrogen')
-    m_oxygen = mass_config.getfloat('Masses', 'm_oxygen')
     if 'theo_mz' not in df:
         df.insert(df.columns.get_loc(mzcolumn)+1, 'theo_mz', np.nan)
     if 'theo_mh' not in df:
         df.insert(df.columns.get_loc('theo_mz'), 'theo_mh', np.nan)
     
-    def _PSMtoMZ(sequence, charge):
-        total_aas = 2*m_hydrogen + m_oxygen
-        total_aas += charge*m_proton
-        total_aas += float(MODs['nt']) + float(MODs['ct'])
-        for aa in sequence:
-            if aa.lower() in AAs:
-                total_aas += float(AAs[aa.lower()])
-            #else: # aminoacid not in list (ask for user input?)
-                # TODO
-            if aa.lower() in MODs:
-                total_aas += float(MODs[aa.lower()])
-        MH = total_aas - (charge-1)*m_proton
-        #MZ = (total_aas + int(charge)*m_proton) / int(charge)
-        MZ = total_aas / int(charge)
-        return MZ, MH
-    
-    df['theo_mz'] = df.apply(lambda x: _PSMtoMZ(x[seqcolumn], x[zcolumn])[0], axis = 1)
-    df['theo_mh'] = df.apply(lambda x: _PSMtoMZ(x[seqcolumn], x[zcolumn])[1], axis = 1)
-    #df['theo_mh'] = df.apply(lambda x: (x['theo_mz'] * x[zcolumn]) - (m_proton * (x[zcolumn]-1)), axis = 1)
+    # Neutral mass is calculated once per unique sequence
+    neutral_mass = neutralMass(df[seqcolumn].astype(str), mass_table, term_mass, mass_cache)
+    df['theo_mz'], df['theo_mh'] = chargeMZ(neutral_mass, df[zcolumn], m_proton)
     return df
 
 def getErrors(df, mzcolumn, calibrated):
@@ -119,7 +115,7 @@ def getErrors(df, mzcolumn, calibrated):
 def filterPeptides(df, scoremin, ppmmax, scorecolumn, chargecolumn, mzcolumn,
                    seqcolumn, proteincolumn, abscolumn, decoyprefix):
     '''    
-    Filter and keep target peptides that match Xcorrmin and PPMmax conditions.
+    Mark target peptides that match Xcorrmin and PPMmax conditions.
     This high-quality subpopulation will be used for calibration.
     '''
     
@@ -131,21 +127,13 @@ def filterPeptides(df, scoremin, ppmmax, scorecolumn, chargecolumn, mzcolumn,
     #     return cxcorr
     
     #keep targets
-    df_filtered = df[~df[proteincolumn]
-                     .str.startswith(decoyprefix)]
+    filtered = ~df[proteincolumn].str.startswith(decoyprefix)
     #keep score > scoremin
-    df_filtered = df_filtered[df_filtered[scorecolumn]
-                              >=scoremin]
+    filtered &= df[scorecolumn] >= scoremin
     #keep abs_error <= ppmmax
-    df_filtered['abs_error_ppm'] = df_filtered[abscolumn]/df_filtered[mzcolumn] * 1e6
-    df_filtered = df_filtered[df_filtered['abs_error_ppm']
-                              <=ppmmax]
-    df_filtered = df_filtered[df_filtered['abs_error_ppm']
-                              >=-ppmmax]
-    df_filtered = df_filtered.drop('abs_error_ppm', axis = 1)
-    logging.info("Number of PSMs before filtering: " + str(df.shape[0]))
-    logging.info("Number of PSMs after filtering: " + str(df_filtered.shape[0]))
-    return df_filtered
+    abs_error_ppm = df[abscolumn]/df[mzcolumn] * 1e6
+    filtered &= (abs_error_ppm <= ppmmax) & (abs_error_ppm >= -ppmmax)
+    return filtered
 
 def getSysError(df_filtered, mzcolumn, calibrated):
     '''
@@ -161,7 +149,7 @@ def getSysError(df_filtered, mzcolumn, calibrated):
     
     if calibrated:
         phi = math.sqrt(2) * erfinv(0.5)
-        mad = df_filtered['cal_ppm'].mad()
+        mad = (df_filtered['cal_ppm'] - df_filtered['cal_ppm'].mean()).abs().mean() # mean absolute deviation
         avg_ppm_error = (mad / phi) 
         logging.info("Systematic error after calibration: " + "{:.4e}".format(sys_error))
         logging.info("Alpha after calibration: " + "{:.4e}".format(alpha))
@@ -172,7 +160,7 @@ def getSysError(df_filtered, mzcolumn, calibrated):
         logging.info("Alpha: " + "{:.4e}".format(alpha))
         return sys_error, alpha
 
-def rawCorrection(df, mzcolumn, alpha):
+def rawCorrection(df, mzcolumn, zcolumn, alpha, m_proton):
     '''
     Correct exp_mz values from infile using the systematic error.
     '''
@@ -182,15 +170,21 @@ def rawCorrection(df, mzcolumn, alpha):
     #if 'exp_mh_cal' not in df:
         #df.insert(df.columns.get_loc('cal_exp_mz')+1, 'exp_mh_cal', np.nan)
     
-    def _correct(exp_mz, abs_error, alpha):
-        cal_exp_mz = exp_mz * (1  - alpha)
-        return cal_exp_mz
-    
     #df['cal_exp_mz'] = df[config._sections['Input']['mzcolumn']] - sys_error
-    df['cal_exp_mz'] = df.apply(lambda x: _correct(x[mzcolumn], x['abs_error'], alpha), axis = 1)
-    df['cal_exp_mh'] = df.apply(lambda x: (x['cal_exp_mz'] * x[config._sections['DMcalibrator']['zcolumn']]) - ((x[config._sections['DMcalibrator']['zcolumn']]-1) * mass_config.getfloat('Masses', 'm_proton')), axis = 1)
+    df['cal_exp_mz'] = df[mzcolumn] * (1  - alpha)
+    df['cal_exp_mh'] = (df['cal_exp_mz'] * df[zcolumn]) - ((df[zcolumn]-1) * m_proton)
     return df
 
+def rawCalibration(df, filtered, mzcolumn, zcolumn, m_proton):
+    '''
+    Calibrate the PSMs of one raw file using its own systematic error.
+    '''
+    # get the RAW value from the input tuple df=(raw,df)
+    (raw_value, df) = df[0], df[1]
+    sys_error, alpha = getSysError(df[filtered], mzcolumn, 0)
+    df = rawCorrection(df, mzcolumn, zcolumn, alpha, m_proton)
+    return raw_value, sys_error, alpha, df
+
 def getDMcal(df, mzcolumn, calmzcolumn, zcolumn):
     '''
     Calculate calibrated DM values.
@@ -223,14 +217,87 @@ def getDMcal(df, mzcolumn, calmzcolumn, zcolumn):
     df['cal_dm_mh'] = (df['cal_dm_mz'] * df[zcolumn])
     return df
 
+def getCalibrationTable(df, base_columns, score_min, ppm_max, scorecolumn, zcolumn, mzcolumn,
+                        seqcolumn, proteincolumn, abscolumn, decoyprefix, mass_cache):
+    '''
+    Make a table with the columns needed for calibration, calculate the
+    theoretical MZ and errors, and mark the high-quality subpopulation.
+    '''
+    cal_df = df[base_columns]
+    # Label targets and decoys
+    cal_df = labelTargetDecoy(cal_df, proteincolumn, decoyprefix)
+    # Calculate theoretical MZ
+    cal_df = getTheoMZ(cal_df, mzcolumn, zcolumn, seqcolumn, mass_cache)
+    # Calculate errors
+    cal_df = getErrors(cal_df, mzcolumn, 0)
+    # Filter identifications (same subset before and after calibration)
+    filtered = filterPeptides(cal_df,
+                              score_min,
+                              ppm_max,
+                              scorecolumn,
+                              zcolumn,
+                              mzcolumn,
+                              seqcolumn,
+                              proteincolumn,
+                              abscolumn,
+                              decoyprefix)
+    return cal_df, filtered
+
+def getCalibratedColumns(cal_df, mzcolumn, calmzcolumn, zcolumn, seqdmcolumn, calseqcolumn, decimal_places):
+    '''
+    Calculate errors, DM values and sequence column after calibration.
+    '''
+    # Recalculate errors using calibrated masses
+    cal_df = getErrors(cal_df, calmzcolumn, 1)
+    # Calculate DMCal 
+    cal_df = getDMcal(cal_df, mzcolumn, calmzcolumn, zcolumn)
+    # Make calseqcolumn
+    cal_df.insert(cal_df.columns.get_loc(seqdmcolumn)+1, calseqcolumn, np.nan)
+    cal_df[calseqcolumn] = makeSeqColumn(cal_df[seqdmcolumn], cal_df['cal_dm_mh'], decimal_places)
+    return cal_df
+
+def joinColumns(df, cal_df, base_columns):
+    '''
+    Add the new columns of cal_df to df in a single concat. Each new column
+    is placed after the same input column it follows in cal_df.
+    '''
+    new_columns = {}
+    anchor = None
+    for column in cal_df.columns:
+        if column in base_columns:
+            anchor = column
+        elif column in df.columns: # overwrite existing columns in place
+            df[column] = cal_df[column]
+        else:
+            new_columns.setdefault(anchor, []).append(column)
+    df_list = []
+    if None in new_columns:
+        df_list.append(cal_df[new_columns[None]])
+    start = 0
+    for i, column in enumerate(df.columns):
+        if column in new_columns:
+            df_list.append(df.iloc[:, start:i+1])
+            df_list.append(cal_df[new_columns[column]])
+            start = i+1
+    df_list.append(df.iloc[:, start:])
+    return pd.concat(df_list, axis=1)
+
 def labelTargetDecoy(df, proteincolumn, decoyprefix):
     '''
     Label targets and decoys according to protein ID column.
     '''
     df.insert(df.columns.get_loc(proteincolumn)+1, 'Label', np.nan)
-    df['Label'] = df.apply(lambda x: 'Decoy' if (x[proteincolumn][0:5]==decoyprefix) else 'Target', axis = 1)
+    df['Label'] = np.where(df[proteincolumn].astype(str).str[0:5]==decoyprefix, 'Decoy', 'Target')
     return df
 
+def makeSeqColumn(seqdm, dm, decimal_places):
+    '''
+    Replace the deltamass within square brackets of each sequence.
+    '''
+    seqdm = seqdm.astype(str)
+    return (seqdm.str.split('[', n=1).str[0] + '[' + dm.round(decimal_places).astype(str) + ']'
+            + seqdm.str.split(']').str[1])
+
 #################
 # Main function #
 #################
@@ -255,62 +322,122 @@ def main(args):
     calmzcolumn = 'cal_exp_mz'
     calseqcolumn = config._sections['DMcalibrator']['calseqcolumn']
     decimal_places = int(config._sections['General']['decimal_places'])
+    rawcolumn = config._sections['DMcalibrator']['rawcolumn']
+    raw_calibration = int(config._sections['DMcalibrator']['raw_calibration'])
+    m_proton = mass_config.getfloat('Masses', 'm_proton')
     
     log_str = "Calibrating file: " + str(Path(args.infile))
     logging.info(log_str)
-    # Read infile
-    df = readInfile(Path(args.infile),
-                    scorecolumn,
-                    mzcolumn,
-                    zcolumn,
-                    seqcolumn,
-                    proteincolumn)
-    # Label targets and decoys
-    df = labelTargetDecoy(df, proteincolumn, decoyprefix)
-    # Calculate theoretical MZ
-    df = getTheoMZ(df, mzcolumn, zcolumn, seqcolumn)
-    # Calculate errors
-    df = getErrors(df, mzcolumn, 0)
-    # Filter identifications
+    outfile = outName(args.infile, '_calibrated', args.out_format)
+    mass_key = massKey(mass_config)
+    mass_cache = readMassCache(args.masscache, mass_key) if args.masscache else {}
+    cache_size = len(mass_cache)
     logging.info("Filtering by score_min = " + str(score_min))
     logging.info("Filtering by ppm_max = " + str(ppm_max))
-    df_filtered = filterPeptides(df,
-                                 score_min,
-                                 ppm_max,
-                                 scorecolumn,
-                                 zcolumn,
-                                 mzcolumn,
-                                 seqcolumn,
-                                 proteincolumn,
-                                 abscolumn,
-                                 decoyprefix)
-    # Use filtered set to calculate systematic error
-    sys_error, alpha = getSysError(df_filtered, mzcolumn, 0)
-    # Use systematic error to correct infile
-    df = rawCorrection(df, mzcolumn, alpha)
-    # Recalculate systematic error using calibrated masses
-    df = getErrors(df, calmzcolumn, 1)
-    df_filtered = filterPeptides(df,
-                                 score_min,
-                                 ppm_max,
-                                 scorecolumn,
-                                 zcolumn,
-                                 mzcolumn,
-                                 seqcolumn,
-                                 proteincolumn,
-                                 abscolumn,
-                                 decoyprefix)
-    cal_sys_error, cal_alpha, avg_ppm_error = getSysError(df_filtered, mzcolumn, 1)
-    # Calculate DMCal 
-    df = getDMcal(df, mzcolumn, calmzcolumn, zcolumn)
-    # Make calseqcolumn
-    df.insert(df.columns.get_loc(seqdmcolumn)+1, calseqcolumn, np.nan)
-    #df[calseqcolumn] = df[seqdmcolumn].split('[')[0] + '[' + str(round(df['cal_dm_mh'], decimal_places)) + ']' + df[seqdmcolumn].split(']')[1]
-    df[calseqcolumn] = df.apply(lambda x: x[seqdmcolumn].split('[')[0] + '[' + str(round(x['cal_dm_mh'], decimal_places)) + ']' + x[seqdmcolumn].split(']')[1], axis = 1)
-    #Write to txt file
-    logging.info("Writing output file...")
-    outfile = args.infile[:-4] + '_calibrated.txt'
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    
+    if args.chunksize:
+        # Read infile twice, chunk by chunk: get systematic error, then correct and write
+        logging.info("Reading input file in chunks of " + str(args.chunksize) + " rows")
+        header = tableColumns(Path(args.infile))
+        base_columns = [c for c in header if c in (scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn, seqdmcolumn)]
+        error_columns = [c for c in header if c in (scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn)
+                                             or (raw_calibration and c == rawcolumn)]
+        # First pass: keep the errors of the high-quality subpopulation
+        n_psms = 0
+        errors = []
+        for df in readInfileChunks(Path(args.infile), args.chunksize, error_columns,
+                                   scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn):
+            cal_df, filtered = getCalibrationTable(df, error_columns, score_min, ppm_max,
+                                                   scorecolumn, zcolumn, mzcolumn, seqcolumn,
+                                                   proteincolumn, abscolumn, decoyprefix, mass_cache)
+            n_psms += len(cal_df)
+            errors.append(cal_df.loc[filtered, [c for c in (abscolumn, mzcolumn, rawcolumn) if c in cal_df]])
+        errors = pd.concat(errors)
+        logging.info("Number of PSMs before filtering: " + str(n_psms))
+        logging.info("Number of PSMs after filtering: " + str(len(errors)))
+        if raw_calibration:
+            # Use filtered set of each raw file to calculate its systematic error
+            logging.info("Calibrating each raw file separately...")
+            raw_alpha = {}
+            for raw_value, raw_errors in errors.groupby(rawcolumn, dropna=False):
+                sys_error, raw_alpha[raw_value] = getSysError(raw_errors, mzcolumn, 0)
+                logging.info("\t" + str(raw_value) + ": systematic error = " + "{:.4e}".format(sys_error)
+                             + ", alpha = " + "{:.4e}".format(raw_alpha[raw_value]))
+        else:
+            # Use filtered set to calculate systematic error
+            sys_error, alpha = getSysError(errors, mzcolumn, 0)
+        del errors
+        # Second pass: use systematic error to correct infile and write it
+        logging.info("Writing output file...")
+        cal_errors = []
+        writer = TableWriter(outfile)
+        for df in readInfileChunks(Path(args.infile), args.chunksize, None,
+                                   scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn):
+            cal_df, filtered = getCalibrationTable(df, base_columns, score_min, ppm_max,
+                                                   scorecolumn, zcolumn, mzcolumn, seqcolumn,
+                                                   proteincolumn, abscolumn, decoyprefix, mass_cache)
+            if raw_calibration:
+                alpha = df[rawcolumn].map(raw_alpha)
+            cal_df = rawCorrection(cal_df, mzcolumn, zcolumn, alpha, m_proton)
+            cal_df = getCalibratedColumns(cal_df, mzcolumn, calmzcolumn, zcolumn,
+                                          seqdmcolumn, calseqcolumn, decimal_places)
+            cal_errors.append(cal_df.loc[filtered, ['cal_dm_mz', 'cal_ppm', mzcolumn]])
+            df = joinColumns(df, cal_df, base_columns)
+            writer.write(df)
+        writer.close()
+        # Systematic error using calibrated masses
+        cal_sys_error, cal_alpha, avg_ppm_error = getSysError(pd.concat(cal_errors), mzcolumn, 1)
+        
+    else:
+        # Read infile
+        df = readInfile(Path(args.infile),
+                        scorecolumn,
+                        mzcolumn,
+                        zcolumn,
+                        seqcolumn,
+                        proteincolumn)
+        # Work on the columns needed for calibration, new columns are joined at the end
+        base_columns = [c for c in df.columns if c in (scorecolumn, mzcolumn, zcolumn, seqcolumn, proteincolumn, seqdmcolumn)]
+        cal_df, filtered = getCalibrationTable(df, base_columns, score_min, ppm_max,
+                                               scorecolumn, zcolumn, mzcolumn, seqcolumn,
+                                               proteincolumn, abscolumn, decoyprefix, mass_cache)
+        logging.info("Number of PSMs before filtering: " + str(len(cal_df)))
+        logging.info("Number of PSMs after filtering: " + str(filtered.sum()))
+        if raw_calibration:
+            # Use filtered set of each raw file to calculate its systematic error and correct it
+            logging.info("Calibrating each raw file separately...")
+            raw_groups = list(cal_df[[mzcolumn, zcolumn, abscolumn]].groupby(df[rawcolumn], dropna=False))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+                raw_list = executor.map(rawCalibration, raw_groups,
+                                                        [filtered[raw[1].index] for raw in raw_groups],
+                                                        repeat(mzcolumn),
+                                                        repeat(zcolumn),
+                                                        repeat(m_proton))
+            raw_df = []
+            for raw_value, sys_error, alpha, raw_cal in raw_list:
+                logging.info("\t" + str(raw_value) + ": systematic error = " + "{:.4e}".format(sys_error)
+                             + ", alpha = " + "{:.4e}".format(alpha))
+                raw_df.append(raw_cal[['cal_exp_mz', 'cal_exp_mh']])
+            raw_df = pd.concat(raw_df)
+            cal_df.insert(cal_df.columns.get_loc(mzcolumn)+1, 'cal_exp_mz', raw_df['cal_exp_mz'])
+            cal_df.insert(cal_df.columns.get_loc('cal_exp_mz')+1, 'cal_exp_mh', raw_df['cal_exp_mh'])
+        else:
+            # Use filtered set to calculate systematic error
+            sys_error, alpha = getSysError(cal_df[filtered], mzcolumn, 0)
+            # Use systematic error to correct infile
+            cal_df = rawCorrection(cal_df, mzcolumn, zcolumn, alpha, m_proton)
+        cal_df = getCalibratedColumns(cal_df, mzcolumn, calmzcolumn, zcolumn,
+                                      seqdmcolumn, calseqcolumn, decimal_places)
+        # Systematic error using calibrated masses
+        cal_sys_error, cal_alpha, avg_ppm_error = getSysError(cal_df[filtered], mzcolumn, 1)
+        # Add new columns to input table
+        df = joinColumns(df, cal_df, base_columns)
+        del cal_df
+        # Write output file
+        logging.info("Writing output file...")
+        writeTable(df, outfile)
+    if args.masscache and len(mass_cache) > cache_size:
+        writeMassCache(args.masscache, mass_key, mass_cache)
     logging.info("Calibration finished")
 
     
@@ -331,6 +458,7 @@ if __name__ == '__main__':
     
     parser.add_argument('-i', '--infile', required=True, help='Path to input file')
     parser.add_argument('-c', '--config', default=defaultconfig, help='Path to custom config.ini file')
+    parser.add_argument('-m', '--masscache', default=None, help='Path to file with the cached sequence masses (created if missing)')
     
     # these will overwrite the config if specified
     parser.add_argument('-s', '--scoremin', default=None, help='Minimum score')
@@ -339,8 +467,13 @@ if __name__ == '__main__':
     parser.add_argument('-zc', '--chargecolumn', default=None, help='Name of the column containing the charge')
     parser.add_argument('-mc', '--mzcolumn', default=None, help='Name of the column containing the experimental m/z')
     parser.add_argument('-se', '--seqcolumn', default=None, help='Name of the column containing the sequence')
+    parser.add_argument('-rc', '--rawcolumn', default=None, help='Name of the column containing the raw file')
+    parser.add_argument('-r', '--raw_calibration', default=None, help='Calibrate each raw file separately, 0=no 1=yes')
     #parser.add_argument('-dm', '--dmcolumn', default=None, help='Name of the column containing the deltamass')
 
+    parser.add_argument('-ch', '--chunksize', type=int, default=None, help='Read and calibrate the input file in chunks of this number of rows (default: whole file)')
+    parser.add_argument('-of', '--out_format', choices=['txt', 'feather', 'parquet'], default=None, help='Format of the output file (default: same as input file)')
+    parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of threads/n_workers (default: %(default)s)')    
     parser.add_argument('-v', dest='verbose', action='store_true', help="Increase output verbosity")
     args = parser.parse_args()
     
@@ -367,6 +500,12 @@ if __name__ == '__main__':
     if args.seqcolumn is not None:
         config.set('DMcalibrator', 'seqcolumn', str(args.seqcolumn))
         config.set('Logging', 'create_ini', '1')
+    if args.rawcolumn is not None:
+        config.set('DMcalibrator', 'rawcolumn', str(args.rawcolumn))
+        config.set('Logging', 'create_ini', '1')
+    if args.raw_calibration is not None:
+        config.set('DMcalibrator', 'raw_calibration', str(args.raw_calibration))
+        config.set('Logging', 'create_ini', '1')
     #if args.dmcolumn is not None:
         #config.set('Input', 'dmcolumn', str(args.dmcolumn))
         #config.set('Logging', 'create_ini', '1')
@@ -377,8 +516,8 @@ if __name__ == '__main__':
         
 
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + '_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + '_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + '_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(message)s',
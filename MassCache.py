@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Module metadata variables
+__author__ = "Andrea Laguillo Gómez"
+__credits__ = ["Andrea Laguillo Gómez", "Jose Rodriguez", "Jesus Vazquez"]
+__license__ = "Creative Commons Attribution-NonCommercial-NoDerivs 4.0 Unported License https://creativecommons.org/licenses/by-nc-nd/4.0/"
+__version__ = "0.0.1"
+__maintainer__ = "Jose Rodriguez"
+__email__ = "andrea.laguillo@cnic.es;jmrodriguezc@cnic.es"
+__status__ = "Development"
+
+# import modules
+import os
+import hashlib
+import logging
+import pandas as pd
+import numpy as np
+
+# Neutral mass of peptide sequences, shared by the modules that need the
+# theoretical mass of a sequence (DMcalibrator, TrunkSolver...).
+# The cache is a dictionary {sequence: neutral mass} that can be kept in memory
+# or saved to disk. Files on disk are tagged with the MassMod.ini contents.
+
+###################
+# Local functions #
+###################
+
+def residueTable(residue_masses):
+    '''
+    Build a lookup table with the mass of each residue, indexed by character code.
+    Residues that are not in residue_masses are NaN (unknown).
+    '''
+    mass_table = np.full(256, np.nan, dtype=np.float64)
+    for aa, mass in residue_masses.items():
+        mass_table[ord(aa)] = np.nan_to_num(mass_table[ord(aa)]) + float(mass)
+    return mass_table
+
+def getMassTable(mass_config):
+    '''
+    Build the residue mass table (amino acid plus fixed modification) and the
+    terminal mass (water and N/C-terminal modifications) from MassMod.ini.
+    '''
+    AAs = dict(mass_config._sections['Aminoacids'])
+    MODs = dict(mass_config._sections['Fixed Modifications'])
+    mass_table = np.zeros(256, dtype=np.float64)
+    known = np.zeros(256, dtype=bool)
+    for residues in (AAs, MODs):
+        for aa, mass in residues.items():
+            if len(aa) == 1: # skip 'nt' and 'ct'
+                mass_table[ord(aa.lower())] += float(mass)
+                mass_table[ord(aa.upper())] += float(mass)
+                known[[ord(aa.lower()), ord(aa.upper())]] = True
+    mass_table[~known] = np.nan # unknown residues
+    term_mass = 2*mass_config.getfloat('Masses', 'm_hydrogen') + mass_config.getfloat('Masses', 'm_oxygen')
+    term_mass += float(MODs['nt']) + float(MODs['ct'])
+    return mass_table, term_mass
+
+def seqMass(sequences, mass_table, strict=False):
+    '''
+    Sum the residue masses of each sequence in an array of sequences.
+    Residues without mass in mass_table count as 0, with a warning, or raise
+    KeyError if strict.
+    '''
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    residues = np.frombuffer(''.join(sequences).encode('ascii', 'replace'), dtype=np.uint8)
+    masses = mass_table[residues]
+    unknown = np.isnan(masses)
+    if unknown.any():
+        message = "Unknown residues in sequences: " + ", ".join(map(chr, np.unique(residues[unknown])))
+        if strict:
+            raise KeyError(message)
+        logging.info("Warning: " + message + " (mass 0)")
+        masses[unknown] = 0
+    owner = np.repeat(np.arange(len(sequences)), lengths)
+    return np.bincount(owner, weights=masses, minlength=len(sequences))
+
+def neutralMass(sequences, mass_table, term_mass, cache, strict=False):
+    '''
+    Calculate the neutral mass of each sequence. Masses are calculated once per
+    unique sequence and the cache is updated with the new ones. Unknown
+    residues are handled as in seqMass.
+    '''
+    seq_codes, uniques = pd.factorize(pd.Series(sequences, dtype=object))
+    uniques = list(uniques)
+    missing = [seq for seq in uniques if seq not in cache]
+    if missing:
+        cache.update(zip(missing, seqMass(missing, mass_table, strict) + term_mass))
+    unique_mass = np.fromiter((cache[seq] for seq in uniques), dtype=np.float64, count=len(uniques))
+    return unique_mass[seq_codes]
+
+def chargeMZ(neutral_mass, charge, m_proton):
+    '''
+    Calculate MZ and MH from the neutral mass for each charge.
+    '''
+    charge = np.asarray(charge, dtype=np.float64)
+    total_mass = neutral_mass + charge*m_proton
+    MZ = total_mass / np.trunc(charge)
+    MH = total_mass - (charge-1)*m_proton
+    return MZ, MH
+
+def massKey(mass_config):
+    '''
+    Identify the masses of a MassMod.ini by the hash of its contents.
+    '''
+    contents = sorted((section, sorted(mass_config.items(section))) for section in mass_config.sections())
+    return hashlib.sha1(str(contents).encode('utf-8')).hexdigest()
+
+def readMassCache(cachefile, mass_key):
+    '''
+    Read a sequence mass cache from disk. The cache is only reused if it was
+    written with the same MassMod.ini.
+    '''
+    if not os.path.isfile(cachefile):
+        return {}
+    with open(cachefile) as f:
+        header = f.readline().strip()
+    if header != '#MassMod: ' + mass_key:
+        logging.info("Mass cache was made with a different MassMod.ini, it will be rebuilt")
+        return {}
+    df = pd.read_csv(cachefile, sep="\t", skiprows=1, float_precision='round_trip', keep_default_na=False)
+    logging.info("Read " + str(len(df)) + " sequence masses from cache")
+    return dict(zip(df['Sequence'], df['NeutralMass']))
+
+def writeMassCache(cachefile, mass_key, cache):
+    '''
+    Write a sequence mass cache to disk, tagged with the MassMod.ini hash.
+    '''
+    with open(cachefile, 'w', newline='') as f:
+        f.write('#MassMod: ' + mass_key + '\n')
+        df = pd.DataFrame({'Sequence': list(cache.keys()), 'NeutralMass': list(cache.values())})
+        df.to_csv(f, index=False, sep='\t', encoding='utf-8')
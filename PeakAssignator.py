@@ -18,10 +18,13 @@ import argparse
 import configparser
 import logging
 import re
+import time
 import pandas as pd
 import concurrent.futures
+from multiprocessing import shared_memory
 from itertools import repeat
 import numpy as np
+from TableIO import readTable, writeTable, outName
 pd.options.mode.chained_assignment = None  # default='warn'
 
 # TODO: allow user to set output column names in the INI
@@ -32,24 +35,26 @@ pd.options.mode.chained_assignment = None  # default='warn'
 ###################
 # Local functions #
 ###################
+def extract_FWHM(file):
+    '''
+    Read the FWHM from a MAD_and_FWHM_calculations file.
+    '''
+    with open(file) as f:
+        data = f.read()
+        m = re.findall(r'FWHM:\s*([^\n]*)', data)
+        if m and len(m)>0:
+            return float(m[0])
+        else:
+            sys.exit("ERROR! FWHM is not defined for {}".format(file))
+
 def concatInfiles(peakpickingfile):
     '''    
     Concat input files...
     adding Experiment column (dirname of input file), and adding a FWHM columns by Experiment
     '''
-    
-    def _extract_FWHM(file):
-        with open(file) as f:
-            data = f.read()
-            m = re.findall(r'FWHM:\s*([^\n]*)', data)
-            if m and len(m)>0:
-                return m[0]
-            else:
-                sys.exit("ERROR! FWHM is not defined for {}".format(file))
-        
     # read input file
     # use high precision with the floats
-    df = pd.read_csv(peakpickingfile, sep="\t", float_precision='high')    
+    df = readTable(peakpickingfile)
     # add folder name into column
     foldername = os.path.dirname(peakpickingfile)
     df['Experiment'] = foldername
@@ -57,8 +62,8 @@ def concatInfiles(peakpickingfile):
     df['Filename'] = os.path.basename(peakpickingfile)
     # add fwhm column
     #fwhm_file = "{}/{}".format(foldername, fwhm_fname)
-    #fwhm = _extract_FWHM(fwhm_file)
-    #fwhm = _extract_FWHM(fwhm_fname)
+    #fwhm = extract_FWHM(fwhm_file)
+    #fwhm = extract_FWHM(fwhm_fname)
     #df['FWHM'] = float(fwhm)
     # assign type to categorical columns
     df['Experiment'] = df['Experiment'].astype('category')
@@ -67,27 +72,109 @@ def concatInfiles(peakpickingfile):
     #df['IsotpicJump'] = df['IsotpicJump'].astype('category')
     return df
 
+def experiment_FWHM(df, infile, fwhm_filename):
+    '''
+    FWHM of the experiment of each PSM, read from the fwhm_filename file in the
+    experiment folder (the folder of the input file if there is no Experiment column).
+    '''
+    if 'Experiment' not in df.columns:
+        return extract_FWHM(os.path.join(os.path.dirname(infile), fwhm_filename))
+    experiments = df['Experiment'].astype('category')
+    fwhm = np.array([extract_FWHM(os.path.join(str(folder), fwhm_filename))
+                     for folder in experiments.cat.categories], dtype=np.float64)
+    return fwhm[experiments.cat.codes.to_numpy()]
+
+def peak_FWHM(histfile, apex_list):
+    '''
+    Estimate the width of each peak from the DM histogram, as the full width at
+    half maximum of the smoothed count around the bin of its apex.
+    '''
+    df_hist = readTable(histfile)
+    midpoints = df_hist['midpoint'].to_numpy(dtype=np.float64)
+    counts = df_hist['count'].to_numpy(dtype=np.float64)
+    if 'smooth_count' in df_hist.columns:
+        counts = np.where(df_hist['smooth_count'].isna(), counts, df_hist['smooth_count'].to_numpy(dtype=np.float64))
+    bin_width = np.median(np.diff(midpoints))
+    apex_bins = np.clip(np.searchsorted(midpoints, np.asarray(apex_list) - bin_width/2), 0, len(midpoints)-1)
+    fwhm = np.empty(len(apex_bins))
+    for i, apex_bin in enumerate(apex_bins): # once per peak
+        half = counts[apex_bin] / 2
+        below_left = np.flatnonzero(counts[:apex_bin] < half)
+        below_right = np.flatnonzero(counts[apex_bin+1:] < half)
+        first = below_left[-1] + 1 if len(below_left) else 0
+        last = apex_bin + below_right[0] if len(below_right) else len(counts) - 1
+        fwhm[i] = (last - first + 1) * bin_width
+    return fwhm
+
 def closest_peak(apex_list, delta_MH):
     '''
-    Assign a delta_MH value to the closest apex in a list
+    Get the position in apex_list of the closest apex to each delta_MH value.
+    Only the two apexes around each value in the sorted list are compared; if
+    both are equally close, the one that comes first in apex_list is taken.
+    '''
+    apex_list = np.asarray(apex_list, dtype=np.float64)
+    delta_MH = np.asarray(delta_MH, dtype=np.float64)
+    order = np.argsort(apex_list, kind='stable')
+    sorted_apex = apex_list[order]
+    # position in apex_list of the first copy of each apex
+    order = order[np.searchsorted(sorted_apex, sorted_apex)]
+    position = np.searchsorted(sorted_apex, delta_MH)
+    left = np.clip(position-1, 0, len(sorted_apex)-1)
+    right = np.clip(position, 0, len(sorted_apex)-1)
+    left_distance = np.abs(sorted_apex[left] - delta_MH)
+    right_distance = np.abs(sorted_apex[right] - delta_MH)
+    closest = np.where((right_distance < left_distance)
+                       | ((right_distance == left_distance) & (order[right] < order[left])),
+                       right, left)
+    index = order[closest]
+    index[np.isnan(delta_MH)] = 0
+    return index
+
+def chunk_closest_peak(shm_name, n_rows, start, stop, apex_list):
+    '''
+    Find the closest apex for rows start:stop of the delta_MH array in shared
+    memory, writing their positions to the output array in shared memory.
     '''
-    peak = min(apex_list, key = lambda x : abs(x - delta_MH))
-    return peak
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arrays = np.ndarray((2, n_rows), dtype=np.float64, buffer=shm.buf)
+    arrays[1, start:stop] = closest_peak(apex_list, arrays[0, start:stop])
+    del arrays
+    shm.close()
 
+def parallel_closest_peak(apex_list, delta_MH, n_workers):
+    '''
+    Find the closest apex for delta_MH values in n_workers processes, each
+    one working on a contiguous range of rows. The input and output arrays
+    are kept in shared memory, so they are not pickled.
+    '''
+    n_rows = len(delta_MH)
+    shm = shared_memory.SharedMemory(create=True, size=max(2*n_rows*8, 1))
+    try:
+        arrays = np.ndarray((2, n_rows), dtype=np.float64, buffer=shm.buf)
+        arrays[0] = delta_MH
+        bounds = np.linspace(0, n_rows, n_workers+1).astype(int)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(chunk_closest_peak, repeat(shm.name), repeat(n_rows),
+                                                  bounds[:-1], bounds[1:], repeat(apex_list)))
+        index = arrays[1].astype(np.int64)
+        del arrays
+    finally:
+        shm.close()
+        shm.unlink()
+    return index
     
-def find_orphans(ppm_max, theo_mass, peak, delta_MH, peak_label, orphan_label):
+def find_orphans(tolerance, max_error, theo_mass, peak, delta_MH, peak_label, orphan_label):
     '''
-    Identify orphans and peaks
+    Identify orphans and peaks. A PSM belongs to its closest peak if it is
+    within max_error of the apex, in ppm if tolerance is 'ppm' and in Da
+    otherwise (one value for all PSMs or one for each PSM).
     '''
-    # window = float(nsigma) * fwhm / 2
-    distance = abs(peak - delta_MH)
+    distance = np.abs(peak - delta_MH)
     distance_ppm = (distance / (theo_mass + peak)) * 1e6
-    #max_distance = abs(float(nsigma) * fwhm / 2)
-    if distance_ppm <= ppm_max:
-        ID = peak_label 
+    if tolerance == 'ppm':
+        ID = np.where(distance_ppm <= max_error, peak_label, orphan_label)
     else:
-        ID = orphan_label
-    # TODO: return ppm
+        ID = np.where(distance <= max_error, peak_label, orphan_label)
     return ID, distance_ppm
 
 # def get_deltamod(col_CalDeltaMH, col_Peak, orphan_label, col_ClosestPeak):
@@ -100,27 +187,36 @@ def find_orphans(ppm_max, theo_mass, peak, delta_MH, peak_label, orphan_label):
 #         deltamod = col_ClosestPeak
 #     return deltamod
 
-def bin_operations(df, apex_list, ppm_max, peak_label, orphan_label,
-                   col_ClosestPeak, col_CalDeltaMH, col_Peak, col_DM, col_TheoMass, col_ppm):
+def assign_operations(df, apex_list, tolerance, max_error, peak_label, orphan_label,
+                      col_ClosestPeak, col_CalDeltaMH, col_Peak, col_DM, col_TheoMass, col_ppm, n_workers,
+                      parallel_rows):
     '''
-    Main function that handles the operations by BIN
+    Main function that handles the peak assignation. With the 'peak' tolerance,
+    max_error has one value for each apex in apex_list. Tables of at least
+    parallel_rows PSMs are split in n_workers processes.
     '''
-    # get the BIN value from the input tuple df=(bin,df)
-    (bin_value, df) = float(df[0]), df[1]
-    
     # assign to peaks
-    df[col_ClosestPeak] = df.apply(lambda x: closest_peak(apex_list, x[col_CalDeltaMH]), axis = 1)
+    delta_MH = df[col_CalDeltaMH].to_numpy(dtype=np.float64)
+    if n_workers > 1 and len(df) >= parallel_rows:
+        logging.info("Assigning peaks in " + str(n_workers) + " chunks in parallel")
+        index = parallel_closest_peak(apex_list, delta_MH, n_workers)
+    else:
+        index = closest_peak(apex_list, delta_MH)
+    peak = np.asarray(apex_list, dtype=np.float64)[index]
+    df[col_ClosestPeak] = peak
+    if tolerance == 'peak':
+        max_error = np.asarray(max_error)[index]
 
     # identify orphans
-    df[col_Peak] = df.apply(lambda x: find_orphans(ppm_max, x[col_TheoMass], x[col_ClosestPeak], x[col_CalDeltaMH], peak_label, orphan_label)[0], axis = 1)
-    df[col_ppm] = df.apply(lambda x: find_orphans(ppm_max, x[col_TheoMass], x[col_ClosestPeak], x[col_CalDeltaMH], peak_label, orphan_label)[1], axis = 1)
-    df[col_Peak] = df[col_Peak].astype('category')
+    ID, distance_ppm = find_orphans(tolerance, max_error, df[col_TheoMass].to_numpy(dtype=np.float64),
+                                    peak, delta_MH, peak_label, orphan_label)
+    df[col_Peak] = pd.Series(ID, index=df.index).astype('category')
+    df[col_ppm] = distance_ppm
     
     # calculate FDR
     
     # create deltamass column # TODO: Recom
-    df[col_DM] = df.apply(lambda x: x[col_CalDeltaMH] if (x[col_Peak]==orphan_label) else x[col_ClosestPeak], axis = 1)
-    #df[col_DM] = df.apply(lambda x: get_deltamod(x[col_CalDeltaMH], x[col_Peak], orphan_label, x[col_ClosestPeak]), axis = 1)
+    df[col_DM] = np.where(ID == orphan_label, delta_MH, peak)
     
     # def peak_FDR():
       # for each peak sort by xcorr (comet) # should we separate recom peaks?
@@ -138,16 +234,16 @@ def bin_operations(df, apex_list, ppm_max, peak_label, orphan_label,
     # df.to_csv(outfile, sep="\t", index=False)
     return df  
     
-#################
-# Main function #
-#################
-
-def main(args):
+def assign_file(infile, apex_list, max_error, config, out_format, n_workers, experiment=False):
     '''
-    Main function
+    Assign the PSMs of one input file to the peaks in apex_list and write the
+    _PeakAssignation file next to it. With experiment, the Experiment and
+    Filename columns are added. Return the number of PSMs.
     '''
     # Variables
-    ppm_max = abs(float(config._sections['PeakAssignator']['ppm_max']))
+    tolerance = config._sections['PeakAssignator']['tolerance'].strip().lower()
+    nsigma = abs(float(config._sections['PeakAssignator']['nsigma']))
+    fwhm_filename = config._sections['PeakAssignator']['fwhm_filename']
     col_TheoMass = config._sections['PeakAssignator']['theomh_column']
     col_CalDeltaMH = config._sections['PeakAssignator']['caldeltamh_column']
     col_ClosestPeak = config._sections['PeakAssignator']['closestpeak_column']
@@ -157,55 +253,20 @@ def main(args):
     peak_label = config._sections['PeakAssignator']['peak_label']
     orphan_label = config._sections['PeakAssignator']['orphan_label']
     seqdmcolumn = config._sections['General']['seqdmcolumn']
+    parallel_rows = int(config._sections['General']['parallel_rows'])
     assignseqcolumn = config._sections['PeakAssignator']['assignseqcolumn']
     decimal_places = int(config._sections['General']['decimal_places'])
-    
-    # logging.info("get the list of files with the inputs")
-    # with open(args.infile) as f:
-    #     infiles = f.readlines()
-    # # you may also want to remove whitespace characters like `\n` at the end of each line
-    # infiles = [x.strip() for x in infiles] 
-    # logging.debug(infiles)
-    
-     # read apex list
-    def _extract_ApexList(file):
-        with open(file) as f:
-            data = f.read().split('\n')
-            data = [x for x in data if x.strip()]
-            data = np.array(data, dtype=np.float64)
-            return data
-    
-    #foldername = os.path.dirname(args.appfile)
-    #apex_file = "{}/{}".format(foldername, args.appfile)
-    #apex_list = _extract_ApexList(apex_file)
-    apex_list = _extract_ApexList(args.appfile)
 
-    #logging.info("concat input files...")
-    #logging.info("adding Experiment column (dirname of input file),")
-    #logging.info("and adding a FWHM column by Experiment")
-    # with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:            
-    #     df = executor.map(concatInfiles, infiles)
-    # df = pd.concat(df)
-    # df.reset_index(drop=True, inplace=True)
-    df = pd.read_csv(args.infile, sep="\t", float_precision='high')
+    if experiment:
+        df = concatInfiles(infile)
+    else:
+        df = readTable(infile)
+    if tolerance == 'fwhm':
+        max_error = nsigma * experiment_FWHM(df, infile, fwhm_filename) / 2
  
-    logging.info("Create a column with the bin")
-    df['bin'] = df[col_CalDeltaMH].astype(str).str.extract(r'^([^\.]*)')
-
-
-    logging.info("Parallel the operations by bin")
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:        
-        df = executor.map(bin_operations, list(df.groupby("bin")), repeat(apex_list),
-                                                                   repeat(ppm_max),
-                                                                   repeat(peak_label),
-                                                                   repeat( orphan_label),
-                                                                   repeat(col_ClosestPeak),
-                                                                   repeat(col_CalDeltaMH),
-                                                                   repeat(col_Peak),
-                                                                   repeat(col_DM),
-                                                                   repeat(col_TheoMass),
-                                                                   repeat(col_ppm)) 
-    df = pd.concat(df)
+    df = assign_operations(df, apex_list, tolerance, max_error, peak_label, orphan_label,
+                           col_ClosestPeak, col_CalDeltaMH, col_Peak, col_DM, col_TheoMass, col_ppm,
+                           n_workers, parallel_rows)
     #logging.info("calculate gobal FDR")
     #df = get_global_FDR(df, args.xcorr)
     #logging.info("sort by DeltaMax cal")
@@ -219,9 +280,9 @@ def main(args):
     
     # Make assignseqcolumn
     df.insert(df.columns.get_loc(seqdmcolumn)+2, assignseqcolumn, np.nan)
-    df[assignseqcolumn] = df.apply(lambda x: x[seqdmcolumn].split('[')[0] + '[' + str(round(x[col_DM], decimal_places)) + ']' + x[seqdmcolumn].split(']')[1], axis = 1)
+    df[assignseqcolumn] = [seq.split('[')[0] + '[' + str(round(dm, decimal_places)) + ']' + seq.split(']')[1]
+                           for seq, dm in zip(df[seqdmcolumn], df[col_DM].tolist())]
 
-    logging.info("Write output file")
     # https://towardsdatascience.com/the-best-format-to-save-pandas-data-414dca023e0d
     # begin:printHDF5
     # Note: Explote the Memory!!!
@@ -230,10 +291,85 @@ def main(args):
     # df.to_hdf('data.h5', key='df', mode='w')
     # end:printHDF5
     # df.to_csv('data.tsv', sep="\t", index=False)
-    outfile = args.infile[:-4] + '_PeakAssignation.txt'
-    #df.to_feather(outfile)
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
-    logging.info("Peak assignation finished.")
+    outfile = outName(infile, '_PeakAssignation', out_format)
+    writeTable(df, outfile)
+    return len(df)
+
+def read_infiles(logfile):
+    '''
+    Get the list of input files from a Peakpicking_Log file (one per line).
+    '''
+    with open(logfile) as f:
+        infiles = [x.strip() for x in f.readlines()]
+    infiles = [x for x in infiles if x]
+    missing = [x for x in infiles if not os.path.isfile(x)]
+    if missing:
+        sys.exit("ERROR: input files not found:\n" + "\n".join(missing))
+    return infiles
+
+#################
+# Main function #
+#################
+
+def main(args):
+    '''
+    Main function
+    '''
+    # Variables
+    tolerance = config._sections['PeakAssignator']['tolerance'].strip().lower()
+    ppm_max = abs(float(config._sections['PeakAssignator']['ppm_max']))
+    da_max = abs(float(config._sections['PeakAssignator']['da_max']))
+    nsigma = abs(float(config._sections['PeakAssignator']['nsigma']))
+    fwhm_filename = config._sections['PeakAssignator']['fwhm_filename']
+    
+     # read apex list
+    def _extract_ApexList(file):
+        with open(file) as f:
+            data = f.read().split('\n')
+            data = [x for x in data if x.strip()]
+            data = np.array(data, dtype=np.float64)
+            return data
+    
+    #foldername = os.path.dirname(args.appfile)
+    #apex_file = "{}/{}".format(foldername, args.appfile)
+    #apex_list = _extract_ApexList(apex_file)
+    apex_list = _extract_ApexList(args.appfile)
+
+    # tolerance for the peak assignation
+    max_error = None
+    if tolerance == 'ppm':
+        max_error = ppm_max
+        logging.info("Tolerance: " + str(ppm_max) + " ppm")
+    elif tolerance == 'da':
+        max_error = da_max
+        logging.info("Tolerance: " + str(da_max) + " Da")
+    elif tolerance == 'fwhm':
+        logging.info("Tolerance: " + str(nsigma) + "*FWHM/2 of each experiment (" + fwhm_filename + ")")
+    elif tolerance == 'peak':
+        histfile = args.histfile if args.histfile else args.appfile[:-12] + 'DMHistogram.txt'
+        max_error = nsigma * peak_FWHM(histfile, apex_list) / 2
+        logging.info("Tolerance: " + str(nsigma) + "*FWHM/2 of each peak in " + histfile)
+    else:
+        sys.exit("ERROR: unknown tolerance " + tolerance + ", use ppm, da, fwhm or peak")
+
+    if args.infile:
+        logging.info("Assign peaks")
+        assign_file(args.infile, apex_list, max_error, config, args.out_format, args.n_workers)
+        logging.info("Peak assignation finished.")
+    else:
+        # one file per worker, each file is assigned in one process
+        infiles = read_infiles(args.logfile)
+        logging.info("Assign peaks in " + str(len(infiles)) + " files")
+        start_time = time.time()
+        n_psms = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+            futures = {executor.submit(assign_file, infile, apex_list, max_error, config,
+                                       args.out_format, 1, True): infile for infile in infiles}
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                n_psms += future.result()
+                logging.info("Assigned " + str(i+1) + "/" + str(len(infiles)) + " files: " + futures[future])
+        logging.info("Peak assignation finished: " + str(len(infiles)) + " files, " + str(n_psms) + " PSMs in "
+                     + str(round(time.time()-start_time, 1)) + " s")
     
 
 if __name__ == '__main__':
@@ -251,16 +387,23 @@ if __name__ == '__main__':
         
     defaultconfig = os.path.join(os.path.dirname(__file__), "config/SHIFTS.ini")
     
-    parser.add_argument('-i',  '--infile', required=True, help='Input file with the peak picking')
+    infiles = parser.add_mutually_exclusive_group(required=True)
+    infiles.add_argument('-i',  '--infile', help='Input file with the peak picking')
+    infiles.add_argument('-l',  '--logfile', help='Peakpicking_Log with the input files to assign in batch, one per line')
     parser.add_argument('-a',  '--appfile', required=True, help='File with the apex list of Mass')
-    #parser.add_argument('-f',  '--fwhm_filename', default='MAD_and_FWHM_calculations.txt', help='File name with the FWHM value (default: %(default)s)')    
+    parser.add_argument('-hf', '--histfile', help='DMHistogram used to estimate the width of each peak (default: DMHistogram of the apex list)')
     parser.add_argument('-c', '--config', default=defaultconfig, help='Path to custom config.ini file')
     
     #parser.add_argument('-mn', '--mindelta', help='Minimum Delta Mass (default: %(default)s)')
     #parser.add_argument('-mx', '--maxdelta', help='Maximum Delta Mass (default: %(default)s)')
+    parser.add_argument('-t',  '--tolerance', choices=['ppm', 'da', 'fwhm', 'peak'], help='Tolerance for peak assignation')
     parser.add_argument('-p',  '--ppm', help='Maximum ppm difference for peak assignation')
+    parser.add_argument('-d',  '--da', help='Maximum difference in Da for peak assignation')
+    parser.add_argument('-n',  '--nsigma', help='Number of FWHMs of the tolerance window')
+    parser.add_argument('-f',  '--fwhm_filename', help='Name of the file with the FWHM of each experiment')
 
-    parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of threads/n_workers (default: %(default)s)')    
+    parser.add_argument('-of', '--out_format', choices=['txt', 'feather', 'parquet'], default=None, help='Format of the output file (default: same as input file)')
+    parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of worker processes: one file each with -l, or row chunks of large inputs (default: %(default)s)')    
     parser.add_argument('-v', dest='verbose', action='store_true', help="Increase output verbosity")
     args = parser.parse_args()
     
@@ -273,12 +416,24 @@ if __name__ == '__main__':
     #if args.maxdelta is not None:
         #config.set('PeakAssignator', 'maxdelta', str(args.maxdelta))
         #config.set('Logging', 'create_ini', '1')
+    if args.tolerance is not None:
+        config.set('PeakAssignator', 'tolerance', str(args.tolerance))
+        config.set('Logging', 'create_ini', '1')
     if args.ppm is not None:
         config.set('PeakAssignator', 'ppm_max', str(args.ppm))
         config.set('Logging', 'create_ini', '1')
+    if args.da is not None:
+        config.set('PeakAssignator', 'da_max', str(args.da))
+        config.set('Logging', 'create_ini', '1')
+    if args.nsigma is not None:
+        config.set('PeakAssignator', 'nsigma', str(args.nsigma))
+        config.set('Logging', 'create_ini', '1')
+    if args.fwhm_filename is not None:
+        config.set('PeakAssignator', 'fwhm_filename', str(args.fwhm_filename))
+        config.set('Logging', 'create_ini', '1')
     # if something is changed, write a copy of ini
     if config.getint('Logging', 'create_ini') == 1:
-        with open(os.path.dirname(args.infile) + '/SHIFTS.ini', 'w') as newconfig:
+        with open(os.path.dirname(args.infile or args.logfile) + '/SHIFTS.ini', 'w') as newconfig:
             config.write(newconfig)
 
     # logging debug level. By default, info level
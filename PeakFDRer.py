@@ -15,17 +15,14 @@ __status__ = "Development"
 import argparse
 import configparser
 import concurrent.futures
-from itertools import repeat
 import logging
 import numpy as np
 import os
 import pandas as pd
 import sys
-import math
+from TableIO import readTable, writeTable, outName
 pd.options.mode.chained_assignment = None  # default='warn'
 
-# TODO recom parameter: if no recom column specified, proceed without spire FDR
-
 ###################
 # Local functions #
 ###################
@@ -46,198 +43,163 @@ def read_experiments(experiments_table):
 
 def make_groups(df, groups):
     '''
-    Add group column to input file with the peak assignation.
+    Add group column to input file with the peak assignation. Experiments are
+    matched once per file name and the column is categorical, so PSMs are
+    grouped by small integer codes.
     '''
-    def _match_file(groups, filename):
-        # if filename in groups['Filename'].unique():
-            # group = df.loc[df['Filename'] == filename]['Experiment']
-            # group.reset_index(drop=True, inplace=True)
-            # group = group[0]
-        # if filename in [x for v in group_dict.values() for x in v]:
-        if filename in group_dict:
-            group = group_dict.get(filename)[0]
-        else:
-            group = 'N/A'
-        return group
-    df['Experiment'] = 'N/A'
-    #df['Experiment'] = df.apply(lambda x: _match_file(groups, x['Filename']), axis = 1)
-    group_dict = {}
-    for x in range(len(groups)):
-        currentid = groups.iloc[x,1]
-        currentvalue = groups.iloc[x,0]
-        group_dict.setdefault(currentid, [])
-        group_dict[currentid].append(currentvalue)
-    df['Experiment'] = np.vectorize(_match_file)(group_dict, df['Filename'])
-    if 'N/A' in df['Experiment'].unique():
-        logging.info('Warning: ' + str(df['Experiment'].value_counts()['N/A']) + ' rows could not be assigned to an experiment!') # They will all be grouped together for FDR calculations
+    filenames = df['Filename'].astype('category')
+    # experiment of each file name, and 'N/A' for files not in the table (last)
+    experiments = pd.Series(groups['Experiment'].to_numpy(dtype=object), index=groups['Filename'].to_numpy(dtype=object))
+    experiments = experiments.reindex(filenames.cat.categories.astype(object)).fillna('N/A').to_list() + ['N/A']
+    experiments = pd.Categorical(experiments)
+    file_codes = filenames.cat.codes.to_numpy()
+    df['Experiment'] = pd.Categorical.from_codes(experiments.codes[file_codes],
+                                                 categories=experiments.categories).remove_unused_categories()
+    if 'N/A' in df['Experiment'].cat.categories:
+        logging.info('Warning: ' + str((df['Experiment'] == 'N/A').sum()) + ' rows could not be assigned to an experiment!') # They will all be grouped together for FDR calculations
     return df
 
-def get_spire_FDR(df, score_column, col_Peak, xcorr_type): #TODO: we don't have xcorr_type, we have recom_data, take out column names
-    #This will be for the group of scans in a peak that are contained within 
-    #one recom-assignated theoretical deltamass. Then, when we do peak_FDR, we
-    #include these as well as the rest of the values in the peak.
-    #Cuando el peak y el spire se solapen, esos escanes lo sometería a ambas FDR
-    # How we will handle filtering is still to be determined.
+def score_order(score, label, region):
     '''
-    Calculate spire FDR for each spire in one bin (1 Da)
+    Order of the rows sorted by score and label, both descending. Among rows
+    with the same score and label, those in the first DM region go first,
+    then they keep their order in the table.
     '''
-    df['SpireFDR'] = 100
-    df['Rank'] = -1
-    df['Spire_Rank_T'] = -1
-    df['Spire_Rank_D'] = -1
-    # TODO: Operations
-    # identify spires (filter by recom HERE OR IN RECOM?)
-    peaks = df[df['Peak'] == 'PEAK'] # filter by Peak
-    recom_peaks = peaks[peaks['XcorType'] == 'RECOM'] # TODO: XcorType needs to be created
-    #recom-identified scans are not necessarily peaks, what to do?
-    grouped_recom_peaks = recom_peaks.groupby(['ClosestPeak']) # group by ClosestPeak
-    for group in grouped_recom_peaks:
-        group_index = group[1].index.values
-        df.loc[group_index] # repeat steps of local_FDR
-        # sort bin
-        if xcorr_type == 0: # by Comet Xcorr
-            df.loc[group_index].sort_values(by=['Xcor', 'Label'], inplace=True, ascending=False)
-        else: # by Comet cXcorr
-            df.loc[group_index].sort_values(by=['CorXcor', 'Label'], inplace=True, ascending=False) # TODO: Fix SHIFTS cXcorr
-        # count targets and decoys
-        df.loc[group_index]['Rank'] = df.loc[group_index].groupby('Label').cumcount()+1 # This column can be deleted later
-        df.loc[group_index]['Spire_Rank_T'] = np.where(df.loc[group_index]['Label']=='Target', df.loc[group_index]['Rank'], 0)
-        df.loc[group_index]['Spire_Rank_T'] = df.loc[group_index]['Spire_Rank_T'].replace(to_replace=0, method='ffill')
-        df.loc[group_index]['Spire_Rank_D'] = np.where(df.loc[group_index]['Label'] == 'Decoy', df.loc[group_index]['Rank'], 0)
-        df.loc[group_index]['Spire_Rank_D'] =  df.loc[group_index]['Spire_Rank_D'].replace(to_replace=0, method='ffill')
-        # calculate local FDR
-        df.loc[group_index]['SpireFDR'] = df.loc[group_index]['Spire_Rank_D']/df.loc[group_index]['Spire_Rank_T']
-    # TODO: End Operations
-    df.drop(['Rank'], axis = 1, inplace = True)
-    return df
+    label_codes, labels = pd.factorize(label, sort=True)
+    return np.lexsort((region, -label_codes, -np.asarray(score, dtype=np.float64)))
 
-def get_peak_FDR(df, score_column, col_Peak, closestpeak_column, recom_data):
+def group_codes(*keys):
     '''
-    Calculate peak FDR for each peak in one bin (1 Da)
+    Integer code of the combination of keys of each row.
     '''
-    df['PeakFDR'] = 100
-    df['Rank'] = -1
-    df['Peak_Rank_T'] = -1
-    df['Peak_Rank_D'] = -1
-    # identify peaks
-    peaks = df[df[col_Peak] == 'PEAK'] # filter by Peak
-    grouped_peaks = peaks.groupby([closestpeak_column]) # group by ClosestPeak
-    # df.get_group("group")
-    #grouped_peaks.groups # group info
-    # for group in grouped_peaks:
-    #     group_index = group[1].index.values
-    #     df.loc[group_index] # repeat steps of local_FDR
-    #     # sort bin
-    #     # if recom_data == 0: # by Comet Xcorr
-    #     #     df.loc[group_index].sort_values(by=['Xcor', 'Label'], inplace=True)
-    #     # else: # by Comet cXcorr
-    #     #     df.loc[group_index].sort_values(by=['CorXcor', 'Label'], inplace=True) # TODO: Fix SHIFTS cXcorr
-    #     df.loc[group_index].sort_values(by=[score_column, 'Label'], inplace=True)
-    #     # count targets and decoys
-    #     df.loc[group_index]['Rank'] = df.loc[group_index].groupby('Label').cumcount()+1 # This column can be deleted later
-    #     df.loc[group_index]['Peak_Rank_T'] = np.where(df.loc[group_index]['Label']=='Target', df.loc[group_index]['Rank'], 0)
-    #     df.loc[group_index]['Peak_Rank_T'] = df.loc[group_index]['Peak_Rank_T'].replace(to_replace=0, method='ffill')
-    #     df.loc[group_index]['Peak_Rank_D'] = np.where(df.loc[group_index]['Label'] == 'Decoy', df.loc[group_index]['Rank'], 0)
-    #     df.loc[group_index]['Peak_Rank_D'] =  df.loc[group_index]['Peak_Rank_D'].replace(to_replace=0, method='ffill')
-    #     # calculate peak FDR
-    #     df.loc[group_index]['PeakFDR'] = df.loc[group_index]['Peak_Rank_D']/df.loc[group_index]['Peak_Rank_T']
-        
-    ###
-    def _peak_FDR(group, score_column):
-        group.sort_values(by=[score_column, 'Label'], inplace=True, ascending=False)
-        group['Rank'] = group.groupby('Label').cumcount()+1 # This column can be deleted later
-        group['Peak_Rank_T'] = np.where(group['Label']=='Target', group['Rank'], 0)
-        group['Peak_Rank_T'] = group['Peak_Rank_T'].replace(to_replace=0, method='ffill')
-        group['Peak_Rank_D'] = np.where(group['Label'] == 'Decoy', group['Rank'], 0)
-        group['Peak_Rank_D'] =  group['Peak_Rank_D'].replace(to_replace=0, method='ffill')
-        # calculate peak FDR
-        group['PeakFDR'] = group['Peak_Rank_D']/group['Peak_Rank_T']
-        return group
-    peaks_df = []
-    for group in grouped_peaks:
-        peak_df = _peak_FDR(group[1], score_column)
-        peaks_df.append(peak_df)
-    if len(peaks_df) > 0:
-        final_peaks_df = pd.concat(peaks_df)
-        # join with df
-        common_index = df.index.intersection(final_peaks_df.index)
-        common_columns = df.columns.intersection(final_peaks_df.columns)
-        df.loc[common_index, common_columns] = final_peaks_df.loc[common_index, common_columns]
-    ###
-    
-    df.drop(['Rank'], axis = 1, inplace = True)
-    return df
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        key_codes, uniques = pd.factorize(key, use_na_sentinel=False)
+        codes = codes * len(uniques) + key_codes
+    return codes
 
-def get_local_FDR(df, score_column, recom_data):
+def fdr_ranks(group, order, is_target, is_decoy):
     '''
-    Calculate local FDR for one bin (1 Da)
+    Number of targets and decoys up to each row within its group, going
+    through the rows of each group in score order (order). Rows are sorted
+    by group keeping the score order, so that the counts are cumulative sums
+    restarted at the beginning of each group. Rows without group (-1) get -1.
     '''
-    # sort bin
-    #if recom_data == 0: # by Comet Xcorr
-        #df.sort_values(by=['Xcor', 'Label'], inplace=True, ascending=False)
-    #else: # by Comet cXcorr
-        #df.sort_values(by=['CorXcor', 'Label'], inplace=Tru, ascending=False) # TODO: Fix SHIFTS cXcorr
-    df.sort_values(by=[score_column, 'Label'], inplace=True, ascending=False)
-        
-    # count targets and decoys
-    df['Rank'] = df.groupby('Label').cumcount()+1 # This column can be deleted later
-    df['Local_Rank_T'] = np.where(df['Label']=='Target', df['Rank'], 0)
-    df['Local_Rank_T'] = df['Local_Rank_T'].replace(to_replace=0, method='ffill')
-    df['Local_Rank_D'] = np.where(df['Label'] == 'Decoy', df['Rank'], 0)
-    df['Local_Rank_D'] =  df['Local_Rank_D'].replace(to_replace=0, method='ffill')
-    df.drop(['Rank'], axis = 1, inplace = True)
-    
-    # calculate local FDR
-    df['LocalFDR'] = df['Local_Rank_D']/df['Local_Rank_T']
-    return df
+    order = order[group[order] >= 0]
+    by_group = order[np.argsort(group[order], kind='stable')]
+    sorted_group = group[by_group]
+    targets = np.cumsum(is_target[by_group], dtype=np.int64)
+    decoys = np.cumsum(is_decoy[by_group], dtype=np.int64)
+    # position of the first row of the group of each row
+    first = np.ones(len(by_group), dtype=bool)
+    first[1:] = sorted_group[1:] != sorted_group[:-1]
+    first = np.maximum.accumulate(np.where(first, np.arange(len(by_group)), 0))
+    rank_T = np.full(len(group), -1, dtype=np.int64)
+    rank_D = np.full(len(group), -1, dtype=np.int64)
+    rank_T[by_group] = targets - np.concatenate([[0], targets[:-1]])[first]
+    rank_D[by_group] = decoys - np.concatenate([[0], decoys[:-1]])[first]
+    return rank_T, rank_D
 
-def get_global_FDR(df, score_column, recom_data, peak_label, col_Peak, closestpeak_column, dm_column, dm_region_limit, n_workers):
+def make_units(group, unit_rows):
     '''
-    Calculate global FDR
+    Split the rows in units of whole groups, of about unit_rows rows each.
+    Each unit is the array of its row positions, in the order of the table.
     '''
-    # get the EXPERIMENT value from the input tuple df=(experiment,df)
-    (experiment_value, df) = df[0], df[1]
-    print("\t\t\t\t\tCalculating Global/Local/Peak FDR for: " + experiment_value)
-    # sort by score
-    # if recom_data == 0: # by Comet Xcorr
-    #     df.sort_values(by=['Xcor', 'Label'], inplace=True, ascending=False)
-    # else: # by Comet cXcorr
-    #     df.sort_values(by=['CorXcor', 'Label'], inplace=True, ascending=False) # TODO: Fix SHIFTS cXcorr
-    
-    #### TODO: make two regions separated by dm_region_limit ####
-    #df.sort_values(by=[dm_column], inplace=True)
-    #df.reset_index(drop=True, inplace=True)
-    df_below =  df.loc[df[dm_column] < dm_region_limit]
-    df_above = df.loc[df[dm_column] >= dm_region_limit]
-    df_list = [df_below, df_above]
-    #############################################################
-    
-    for each_df in df_list:
-        each_df.sort_values(by=[score_column, 'Label'], inplace=True, ascending=False)
-            
-        # count targets and decoys
-        each_df['Rank'] = each_df.groupby('Label').cumcount()+1 # This column can be deleted later
-        each_df['Global_Rank_T'] = np.where(each_df['Label']=='Target', each_df['Rank'], 0)
-        each_df['Global_Rank_T'] = each_df['Global_Rank_T'].replace(to_replace=0, method='ffill')
-        each_df['Global_Rank_D'] = np.where(each_df['Label'] == 'Decoy', each_df['Rank'], 0)
-        each_df['Global_Rank_D'] =  each_df['Global_Rank_D'].replace(to_replace=0, method='ffill')
-        each_df.drop(['Rank'], axis = 1, inplace = True)
-        
-        # calculate global FDR
-        each_df['GlobalFDR'] = each_df['Global_Rank_D']/each_df['Global_Rank_T']
-    
-    df = pd.concat([df_below, df_above])
+    by_group = np.argsort(group, kind='stable')
+    sorted_group = group[by_group]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_group[1:] != sorted_group[:-1]]))
+    cuts = np.unique(np.searchsorted(starts, np.arange(unit_rows, len(group), unit_rows)))
+    cuts = starts[cuts[(cuts > 0) & (cuts < len(starts))]]
+    return [np.sort(rows) for rows in np.split(by_group, cuts)]
+
+def unit_ranks(score, label, region, groups, is_target, is_decoy):
+    '''
+    Calculate the ranks of the rows of one unit for each array of groups.
+    '''
+    order = score_order(score, label, region)
+    return [fdr_ranks(group, order, is_target, is_decoy) for group in groups]
+
+def parallel_ranks(score, label, region, groups, is_target, is_decoy, n_workers):
+    '''
+    Calculate the ranks of the global, local and peak groups in one
+    pool of n_workers processes. The work is split in units of whole groups
+    balanced by number of rows: DM regions of an experiment for the global
+    ranks, and local bins of an experiment (with their peaks) for the other
+    ranks. Only the arrays of each unit are sent to the workers, largest first.
+    '''
+    unit_rows = max(len(score) // (4*n_workers), 1)
+    tasks = [(rows, [0]) for rows in make_units(groups[0], unit_rows)]
+    tasks += [(rows, list(range(1, len(groups)))) for rows in make_units(groups[1], unit_rows)]
+    tasks.sort(key=lambda task: len(task[0]), reverse=True)
+    logging.info("Calculating FDR in " + str(len(tasks)) + " units with " + str(n_workers) + " workers")
+    ranks = [(np.full(len(score), -1, dtype=np.int64), np.full(len(score), -1, dtype=np.int64)) for group in groups]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(unit_ranks, score[rows], label[rows], region[rows],
+                                   [groups[level][rows] for level in levels],
+                                   is_target[rows], is_decoy[rows]): (rows, levels) for rows, levels in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            rows, levels = futures[future]
+            for level, (rank_T, rank_D) in zip(levels, future.result()):
+                ranks[level][0][rows] = rank_T
+                ranks[level][1][rows] = rank_D
+    return ranks
+
+def get_FDR(df, score_column, peak_label, col_Peak, closestpeak_column, dm_column, dm_region_limit, n_workers,
+            parallel_rows, in_spire=None, spire_score_column=None):
+    '''
+    Calculate global FDR (by experiment and DM region), local FDR (by experiment
+    and local bin) and peak FDR (by experiment, local bin and closest peak, only
+    for PSMs in peaks). The rows are sorted by score once for all of them,
+    or once for each unit of work in n_workers processes for tables of at
+    least parallel_rows PSMs.
+    If in_spire is given, also spire FDR (as peak FDR, only for PSMs in peaks
+    that are spires), sorting by spire_score_column (by score if not given).
+    '''
+    score = df[score_column].to_numpy(dtype=np.float64)
+    label = pd.factorize(df['Label'], sort=True)[0]
+    region = (df[dm_column] >= dm_region_limit).to_numpy()
+    is_target = (df['Label'] == 'Target').to_numpy()
+    is_decoy = (df['Label'] == 'Decoy').to_numpy()
+    in_peak = (df[col_Peak] == peak_label).to_numpy()
     
-    # calculate local and peak FDR
-    #logging.info("Calculating Local and Peak FDR for: " + experiment_value)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:        
-        df = executor.map(bin_operations, list(df.groupby('LocalBin')), repeat(score_column),
-                                                                   repeat(recom_data), 
-                                                                   repeat(peak_label),
-                                                                   repeat(col_Peak),
-                                                                   repeat(closestpeak_column)) 
-    df = pd.concat(df)
+    global_group = group_codes(df['Experiment'], region)
+    local_group = group_codes(df['Experiment'], df['LocalBin'])
+    peak_group = np.where(in_peak, group_codes(local_group, df[closestpeak_column]), -1)
+    groups = [global_group, local_group, peak_group]
+    if n_workers > 1 and len(df) >= parallel_rows:
+        ranks = parallel_ranks(score, label, region, groups, is_target, is_decoy, n_workers)
+    else:
+        ranks = unit_ranks(score, label, region, groups, is_target, is_decoy)
+    if in_spire is not None:
+        in_spire = in_spire & in_peak
+        if spire_score_column is not None:
+            score = df[spire_score_column].to_numpy(dtype=np.float64)
+        # only the spire rows are sorted by their score
+        rows = np.flatnonzero(in_spire)
+        spire_ranks = (np.full(len(df), -1, dtype=np.int64), np.full(len(df), -1, dtype=np.int64))
+        for spire_rank, unit_rank in zip(spire_ranks, unit_ranks(score[rows], label[rows], region[rows], [peak_group[rows]],
+                                                                 is_target[rows], is_decoy[rows])[0]):
+            spire_rank[rows] = unit_rank
+        ranks.append(spire_ranks)
     
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rank_T, rank_D = ranks[0]
+        df['Global_Rank_T'] = rank_T
+        df['Global_Rank_D'] = rank_D
+        df['GlobalFDR'] = rank_D / rank_T
+        rank_T, rank_D = ranks[1]
+        df['Local_Rank_T'] = rank_T
+        df['Local_Rank_D'] = rank_D
+        df['LocalFDR'] = rank_D / rank_T
+        rank_T, rank_D = ranks[2]
+        df['PeakFDR'] = np.where(in_peak, rank_D / rank_T, 100)
+        df['Peak_Rank_T'] = rank_T
+        df['Peak_Rank_D'] = rank_D
+        if in_spire is not None:
+            rank_T, rank_D = ranks[3]
+            df['SpireFDR'] = np.where(in_spire, rank_D / rank_T, 100)
+            df['Spire_Rank_T'] = rank_T
+            df['Spire_Rank_D'] = rank_D
     return df
 
 def filtering(df, fdr_filter, target_filter): # This goes on a separate module now
@@ -247,44 +209,37 @@ def filtering(df, fdr_filter, target_filter): # This goes on a separate module n
         df[df['GlobalFDR'] >= fdr_filter]
     return df
 
-def bin_operations(df, score_column, recom_data, peak_label, col_Peak, closestpeak_column):
+def make_bins(col_CalDeltaMH):
     '''
-    Main function that handles the operations by BIN
+    Make bins for local FDR, centered at .5 Da. The bin of each PSM is given
+    as a categorical of integers: bin k goes from k-0.5 to k+0.5.
     '''
-    
-    # get the BIN value from the input tuple df=(bin,df)
-    (bin_value, df) = df[0], df[1]
-    
-    # calculate local FDR
-    df = get_local_FDR(df, score_column, recom_data)
-    
-    # calculate peak FDR
-    df = get_peak_FDR(df, score_column, col_Peak, closestpeak_column, recom_data)
-    
-    # calculate spire FDR
-    #if recom_data: #recom_data =! 0
-    #df = get_spire_FDR(df, score_column, col_Peak, recom_data)
-    
-    return df
+    decimal, deltamass = np.modf(np.asarray(col_CalDeltaMH, dtype=np.float64))
+    half = np.abs(decimal) >= 0.5
+    # deltamass is -0.0 between -1 and 0, so those PSMs are binned as positive ones
+    local_bin = np.where(deltamass >= 0, deltamass + half, deltamass - half)
+    valid = ~np.isnan(local_bin)
+    bins = np.unique(local_bin[valid]).astype(np.int64)
+    codes = np.full(len(local_bin), -1, dtype=np.int64)
+    codes[valid] = np.searchsorted(bins, local_bin[valid])
+    return pd.Categorical.from_codes(codes, categories=bins)
 
-def make_bins(col_CalDeltaMH):
+def bin_label(local_bin):
     '''
-    Make bins for local FDR, centered at .5 Da
+    Label of a local bin number, for the output.
     '''
     bin_width = 1 #Da
-    decimal, deltamass = math.modf(float(col_CalDeltaMH))
-    if deltamass >= 0:
-        if abs(decimal) >= 0.5:
-            local_bin = deltamass + 0.5
-        else:
-            local_bin = deltamass -0.5
-    else:
-        if abs(decimal) >= 0.5:
-            local_bin = deltamass - 1.5
-        else:
-            local_bin = deltamass - 0.5
-    local_bin_str = str(local_bin) + " to " + str(local_bin + bin_width)
-    return local_bin_str
+    return str(float(local_bin) - 0.5) + " to " + str(float(local_bin) - 0.5 + bin_width)
+
+def label_bins(local_bin):
+    '''
+    Labels of the local bins of the PSMs, for the output. PSMs without
+    deltamass are labelled "nan to nan", and share a local bin as before.
+    '''
+    local_bin = local_bin.cat.rename_categories(bin_label)
+    if local_bin.isna().any():
+        local_bin = local_bin.cat.add_categories(bin_label(np.nan)).fillna(bin_label(np.nan))
+    return local_bin
     
 
 #################
@@ -297,10 +252,14 @@ def main(args):
     '''
     # Main variables
     n_workers = args.n_workers
+    parallel_rows = int(config._sections['General']['parallel_rows'])
     score_column = config._sections['PeakFDRer']['score_column']
     dm_column = config._sections['PeakFDRer']['dm_column']
     dm_region_limit = float(config._sections['PeakFDRer']['dm_region_limit'])
-    recom_data = config._sections['PeakFDRer']['recom_data']
+    recom_data = int(config._sections['PeakFDRer']['recom_data'])
+    spire_column = config._sections['SpireAssignator']['spire_column']
+    spire_label = config._sections['SpireAssignator']['spire_label']
+    recom_column = config._sections['SpireAssignator']['recom_column']
     peak_label = config._sections['PeakAssignator']['peak_label']
     col_Peak = config._sections['PeakAssignator']['peak_column']
     col_CalDeltaMH = config._sections['PeakAssignator']['caldeltamh_column']
@@ -310,8 +269,7 @@ def main(args):
     
     # Read input file
     logging.info('Read input file')
-    #df = pd.read_feather(args.infile)
-    df = pd.read_csv(args.infile, sep="\t", float_precision='high')
+    df = readTable(args.infile)
     
     # Add groups
     logging.info('Read experiments table')
@@ -323,33 +281,25 @@ def main(args):
         logging.info('\t' + key + ': ' + str(len(group_dict[key])) + ' files')
     
     logging.info("Binning")
-    df['LocalBin'] = np.vectorize(make_bins)(df[col_CalDeltaMH])
-    # logging.info("Calculate Peak and Local FDR")
-    # with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:        
-    #     df = executor.map(bin_operations, list(df.groupby('LocalBin')), repeat(score_column),
-    #                                                                repeat(recom_data), 
-    #                                                                repeat(peak_label),
-    #                                                                repeat(col_Peak),
-    #                                                                repeat(closestpeak_column)) 
-    # df = pd.concat(df)
-    #df.drop(['LocalBin'], axis = 1, inplace = True)
+    df['LocalBin'] = make_bins(df[col_CalDeltaMH])
+    
+    in_spire = None
+    if recom_data:
+        if spire_column not in df.columns:
+            sys.exit("ERROR: spire column " + spire_column + " not found, needed for the Recom analysis (recom_data = 1)")
+        if recom_column not in df.columns:
+            sys.exit("ERROR: Recom score column " + recom_column + " not found, needed for the Recom analysis (recom_data = 1)")
+        in_spire = (df[spire_column] == spire_label).to_numpy()
+        logging.info("Spires: " + str(in_spire.sum()) + " PSMs, spire FDR by " + recom_column)
     
     logging.info("Calculate FDR")
-    # df = get_global_FDR(df, score_column, recom_data)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
-        df = executor.map(get_global_FDR, list(df.groupby('Experiment')), repeat(score_column),
-                                                                          repeat(recom_data),
-                                                                          repeat(peak_label),
-                                                                          repeat(col_Peak),
-                                                                          repeat(closestpeak_column),
-                                                                          repeat(dm_column),
-                                                                          repeat(dm_region_limit),
-                                                                          repeat(n_workers))
-    df = pd.concat(df)
+    df = get_FDR(df, score_column, peak_label, col_Peak, closestpeak_column, dm_column, dm_region_limit, n_workers,
+                 parallel_rows, in_spire, recom_column)
     
     logging.info("Sort by calibrated DeltaMass")
     df.sort_values(by=[col_CalDeltaMH], inplace=True)
     df.reset_index(drop=True, inplace=True)
+    df['LocalBin'] = label_bins(df['LocalBin'])
     
     # TODO: groups?????
     
@@ -373,9 +323,8 @@ def main(args):
     # end:printHDF5
     # df.to_csv('data.tsv', sep="\t", index=False)
     
-    outfile = args.infile[:-4] + '_FDR.txt'
-    #df.to_feather(outfile)
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(args.infile, '_FDR', args.out_format)
+    writeTable(df, outfile)
     
 
     
@@ -395,16 +344,17 @@ if __name__ == '__main__':
         
     defaultconfig = os.path.join(os.path.dirname(__file__), "config/SHIFTS.ini")
     
-    parser.add_argument('-i',  '--infile', required=True, help='Input feather file with the peak assignation')
+    parser.add_argument('-i',  '--infile', required=True, help='Input file (txt, feather or parquet) with the peak assignation')
     parser.add_argument('-e',  '--experiment_table', required=True, help='Tab-separated file containing experiment names and file paths')
     parser.add_argument('-c', '--config', default=defaultconfig, help='Path to custom config.ini file')
     
     parser.add_argument('-s',  '--score_column', help='Name of column with score for FDR calculation')
     #parser.add_argument('-f',  '--fdr_filter', help='FDR value to filter by')
     #parser.add_argument('-t',  '--target_filter', help='Filter targets, 0=no 1=yes')
-    parser.add_argument('-r',  '--recom_data', help='Score for FDR calculation: 0=Xcorr, 1=cXcorr (default: %(default)s)')
+    parser.add_argument('-r',  '--recom_data', help='Recom analysis, calculate spire FDR: 0=no 1=yes')
 
-    parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of threads/n_workers (default: %(default)s)')    
+    parser.add_argument('-of', '--out_format', choices=['txt', 'feather', 'parquet'], default=None, help='Format of the output file (default: same as input file)')
+    parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of worker processes for the FDR of large inputs (default: %(default)s)')    
     parser.add_argument('-v', dest='verbose', action='store_true', help="Increase output verbosity")
     args = parser.parse_args()
     
@@ -429,8 +379,8 @@ if __name__ == '__main__':
             config.write(newconfig)
 
     # logging debug level. By default, info level
-    log_file = args.infile[:-4] + '_FDR_log.txt'
-    log_file_debug = args.infile[:-4] + '_FDR_log_debug.txt'
+    log_file = os.path.splitext(args.infile)[0] + '_FDR_log.txt'
+    log_file_debug = os.path.splitext(args.infile)[0] + '_FDR_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(message)s',
@@ -32,6 +32,7 @@ from tkinter import font as tkfont
 from tkinter import filedialog as fd
 
 import pdb
+from TableIO import readTable
 
 
 ########################
@@ -66,7 +67,7 @@ class PlotObject():
         self.path = path
         
         try:
-            self.data = pd.read_csv(self.path, sep="\t", float_precision='high')
+            self.data = readTable(self.path)
             self.read = True
         
         except:
@@ -143,7 +144,7 @@ class PlotObject():
         logging.info("Reading peaks list")
 
         try:
-            df_peaks = pd.read_csv(path, sep="\t", float_precision="high")
+            df_peaks = readTable(path, usecols=['DM', 'Name'])
         
         except:
             logging.info(f"Error reading peaks list: {sys.exc_info()[0]}")
@@ -631,8 +632,8 @@ if __name__ == '__main__':
 
     # logging debug level. By default, info level
     if args.infile:
-        log_file = outfile = args.infile[:-4] + '_log.txt'
-        log_file_debug = outfile = args.infile[:-4] + '_log_debug.txt'
+        log_file = outfile = os.path.splitext(args.infile)[0] + '_log.txt'
+        log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_log_debug.txt'
     
     else:
         log_file = outfile = 'log.txt'
@@ -14,12 +14,15 @@ __status__ = "Development"
 # import modules
 import os
 import sys
+import math
+import itertools
 import argparse
 import configparser
 import logging
 import pandas as pd
 import numpy as np
 import concurrent.futures
+from TableIO import readTable, outName, mapFiles, TableWriter
 pd.options.mode.chained_assignment = None  # default='warn'
 
 #infile = r"C:\Users\Andrea\Desktop\SHIFTS-4\testing\cXcorr_Len_Rank_Results_TargetData_Calibration.txt"
@@ -29,13 +32,13 @@ pd.options.mode.chained_assignment = None  # default='warn'
 ###################
 # Local functions #
 ###################
-def concatInfiles(infile):
+def concatInfiles(infile, usecols=None):
     '''    
     Concat input files...
     '''
     
-    # read input file
-    df = pd.read_csv(infile, sep="\t", float_precision='high')
+    # read input file (only the usecols columns if given)
+    df = readTable(infile, usecols)
     #df['Experiment'] = infile[0]
     df['Filename'] = infile
     # add folder name into column
@@ -48,76 +51,137 @@ def concatInfiles(infile):
     df['Filename'] = df['Filename'].astype('category')
     return df
 
-def generate_histogram(df, bin_width):
+def decimal_places(x):
     '''
-    Group by DeltaMass into bins of the size specified.
+    Number of decimal places of a number.
     '''
-    
-    def _decimal_places(x):
-        s = str(x)
-        if not '.' in s:
-            return 0
-        return len(s) - s.index('.') - 1
-    
-    # sort by deltamass
-    df.sort_values(by=['cal_dm_mh'], inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    
-    # make bins
-    bins = list(np.arange(int(round(df['cal_dm_mh'][0])),
-                          int(round(df['cal_dm_mh'].iloc[-1]))+bin_width,
-                          bin_width))
-    bins = [round(x, _decimal_places(bin_width)) for x in bins]
-    df['bin'] = pd.cut(df['cal_dm_mh'], bins=bins)
-    
-    # make histogram table
-    bins_df = df['bin'].value_counts().to_frame().rename(columns = {'bin':'count'})
-    bins_df.insert(0, 'bin', bins_df.index)
-    bins_df.insert(1, 'midpoint', bins_df['bin'].apply(lambda x: x.mid))
-    bins_df.reset_index(drop=True, inplace=True)
-    bins_df.sort_values(by=['bin'], inplace=True)
-    bins_df.reset_index(drop=True, inplace=True)
-    #bins_df['bin'][9].left #access value
-    
-    return df, bins_df
+    s = str(x)
+    if not '.' in s:
+        return 0
+    return len(s) - s.index('.') - 1
 
-def linear_regression(bin_subset, smoothed, second_derivative):
+def bin_edges(first_bin, n_bins, bin_width):
     '''
-    Calculate the linear regression line and return the slope
-    (and the intercept, if called with smooth == True).
+    Edges of n_bins consecutive bins of the fixed grid, starting at bin number
+    first_bin. Bin k is the interval (k*bin_width, (k+1)*bin_width].
     '''
-    # ignore special cases at beginning and end and use a
-    # linear regression function for the rest
-    x_list = bin_subset['midpoint'].tolist()
-    if smoothed:
-        y_list = bin_subset['smooth_count'].tolist()
-    elif not second_derivative:
-        y_list = bin_subset['count'].tolist()
-    else:
-        y_list = bin_subset['slope1'].tolist()
-    sum1, sum2 = 0, 0
-    for i in range(len(x_list)):
-        sum1 += (x_list[i] - np.mean(x_list)) * (y_list[i] - np.mean(y_list))
-        sum2 += (x_list[i] - np.mean(x_list)) ** 2
-    working_slope = sum1 / sum2
-    intercept = np.mean(y_list) - working_slope*np.mean(x_list)
-    if smoothed or second_derivative:
-        return working_slope
-    else:
-        return working_slope, intercept
+    edges = np.arange(first_bin, first_bin+n_bins+1) * bin_width
+    return np.round(edges, decimal_places(bin_width))
+
+def bin_index(deltamass, bin_width):
+    '''
+    Number of the fixed-grid bin of each deltamass value (NaN if missing).
+    Values just beside an edge are moved to the side of the rounded edge.
+    '''
+    decimals = decimal_places(bin_width)
+    k = np.ceil(deltamass / bin_width) - 1
+    k -= deltamass <= np.round(k * bin_width, decimals)
+    k += deltamass > np.round((k+1) * bin_width, decimals)
+    return k
+
+def file_histogram(infile, bin_width, usecols=None):
+    '''
+    Read an input file and count its PSMs in the fixed grid of bins.
+    Return the table with a bin column, the number of its first bin and
+    the counts from that bin on.
+    '''
+    df = concatInfiles(infile, usecols)
+    k = bin_index(df['cal_dm_mh'].to_numpy(dtype=np.float64), bin_width)
+    valid = ~np.isnan(k)
+    if not valid.any(): # all bins missing, with the same type of column
+        intervals = pd.IntervalIndex.from_breaks(bin_edges(0, 0, bin_width), closed='right')
+        df['bin'] = pd.Categorical.from_codes(np.full(len(df), -1), intervals)
+        return df, 0, np.zeros(0, dtype=np.int64)
+    k = k[valid].astype(np.int64)
+    first_bin = int(k.min())
+    counts = np.bincount(k - first_bin)
+    codes = np.full(len(df), -1, dtype=np.int64)
+    codes[valid] = k - first_bin
+    intervals = pd.IntervalIndex.from_breaks(bin_edges(first_bin, len(counts), bin_width), closed='right')
+    df['bin'] = pd.Categorical.from_codes(codes, intervals)
+    return df, first_bin, counts
+
+def no_psms():
+    '''
+    Stop if no input file has PSMs with deltamass.
+    '''
+    logging.error("No PSMs with deltamass (cal_dm_mh) in the input files")
+    sys.exit(1)
+
+def merge_histograms(histograms):
+    '''
+    Add up the bin counts of several files, given as (first bin, counts) pairs.
+    '''
+    histograms = [(first, counts) for first, counts in histograms if len(counts) > 0]
+    if not histograms:
+        no_psms()
+    first_bin = min(first for first, counts in histograms)
+    last_bin = max(first + len(counts) for first, counts in histograms)
+    total = np.zeros(last_bin - first_bin, dtype=np.int64)
+    for first, counts in histograms:
+        total[first-first_bin:first-first_bin+len(counts)] += counts
+    return first_bin, total
+
+def histogram_table(first_bin, counts, bin_width):
+    '''
+    Make the histogram table (bin, midpoint, count) from the first to the last
+    bin with PSMs.
+    '''
+    full = np.flatnonzero(counts)
+    counts = counts[full[0]:full[-1]+1]
+    first_bin += int(full[0])
+    edges = bin_edges(first_bin, len(counts), bin_width)
+    bins_df = pd.DataFrame({'bin': pd.IntervalIndex.from_breaks(edges, closed='right'),
+                            'midpoint': 0.5 * (edges[:-1] + edges[1:]),
+                            'count': counts})
+    return bins_df
+
+def window_regression(x, y, points):
+    '''
+    Calculate the slope and intercept of the linear regression line through
+    each window of 2*points+1 consecutive bins, for the bin in the middle
+    (NaN where the window does not fit). All windows are done at once,
+    adding up one window position at a time in the same order as a loop
+    over the bins, so that the results are identical.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = 2*points + 1
+    slope = np.full(len(x), np.nan)
+    intercept = np.full(len(x), np.nan)
+    if len(x) < size:
+        return slope, intercept
+    x_windows = np.lib.stride_tricks.sliding_window_view(x, size)
+    y_windows = np.lib.stride_tricks.sliding_window_view(y, size)
+    x_mean = np.ascontiguousarray(x_windows).mean(axis=1)
+    y_mean = np.ascontiguousarray(y_windows).mean(axis=1)
+    sum1 = np.zeros(len(x_windows))
+    sum2 = np.zeros(len(x_windows))
+    for i in range(size):
+        x_dev = x_windows[:, i] - x_mean
+        sum1 += x_dev * (y_windows[:, i] - y_mean)
+        sum2 += x_dev ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        working_slope = sum1 / sum2
+    slope[points:len(x)-points] = working_slope
+    intercept[points:len(x)-points] = y_mean - working_slope*x_mean
+    return slope, intercept
+
+def trim_ends(values, n):
+    '''
+    Set the first and last n values to NaN.
+    '''
+    values[:n] = np.nan
+    values[len(values)-n:] = np.nan
+    return values
 
 def smoothing(bins_df, spoints):
     '''
     Calculate the slope (first derivative) for each bin. Calculate new smoothed
     value for the midpoint using the linear regression line.
     '''
-    bins_df['smooth_count'] = None
-    for i in range(spoints, len(bins_df)-spoints):
-        #working_bin = bins_df.loc[i]
-        bin_subset = bins_df[i-spoints:i+spoints+1]
-        working_slope, intercept = linear_regression(bin_subset, False, False)
-        bins_df.loc[i, 'smooth_count'] = intercept + (working_slope*bins_df.loc[i, 'midpoint'])
-    bins_df[["smooth_count"]] = bins_df[["smooth_count"]].apply(pd.to_numeric)
+    working_slope, intercept = window_regression(bins_df['midpoint'], bins_df['count'], spoints)
+    bins_df['smooth_count'] = intercept + (working_slope*bins_df['midpoint'].to_numpy())
     return bins_df
 
 def first_derivative(bins_df, points, spoints):
@@ -133,17 +197,12 @@ def first_derivative(bins_df, points, spoints):
     if spoints > 0: #smoothing
         bins_df = smoothing(bins_df, spoints)
         j = 2
+        y = bins_df['smooth_count']
     else: #no smoothing
         j = 1
-    bins_df['slope1'] = None
-    for i in range(points*j, len(bins_df)-points*j):
-        #working_bin = bins_df.loc[i]
-        bin_subset = bins_df[i-points:i+points+1]
-        if spoints > 0:
-            bins_df.loc[i, 'slope1'] = linear_regression(bin_subset, True, False)
-        else:
-            bins_df.loc[i, 'slope1'] = linear_regression(bin_subset, False, False)[0] #slope only
-    bins_df[['slope1']] = bins_df[['slope1']].apply(pd.to_numeric)
+        y = bins_df['count']
+    working_slope, intercept = window_regression(bins_df['midpoint'], y, points)
+    bins_df['slope1'] = trim_ends(working_slope, points*j)
     return bins_df
 
 def second_derivative(bins_df, points, spoints):
@@ -154,13 +213,113 @@ def second_derivative(bins_df, points, spoints):
         j = 3
     else: #not smoothed
         j = 2
-    bins_df['slope2'] = None
-    for i in range(points*j, len(bins_df)-points*j):
-        bin_subset = bins_df[i-points:i+points+1]
-        bins_df.loc[i, 'slope2'] = linear_regression(bin_subset, False, True)
-    bins_df[['slope2']] = bins_df[['slope2']].apply(pd.to_numeric)           
+    working_slope, intercept = window_regression(bins_df['midpoint'], bins_df['slope1'], points)
+    bins_df['slope2'] = trim_ends(working_slope, points*j)
     return bins_df
 
+def read_deltamass(infile):
+    '''
+    Read only the deltamass column of an input file.
+    '''
+    return readTable(infile, usecols=['cal_dm_mh'])['cal_dm_mh'].to_numpy(dtype=np.float64)
+
+def deltamass_histogram(deltamass, bin_width):
+    '''
+    Count deltamass values in the fixed grid of bins. Return the number of
+    the first bin and the counts from that bin on.
+    '''
+    k = bin_index(deltamass, bin_width)
+    k = k[~np.isnan(k)].astype(np.int64)
+    if len(k) == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    first_bin = int(k.min())
+    return first_bin, np.bincount(k - first_bin)
+
+def file_counts(infile, bin_width):
+    '''
+    Count the PSMs of an input file in the fixed grid of bins, reading only
+    the deltamass column.
+    '''
+    return deltamass_histogram(read_deltamass(infile), bin_width)
+
+def width_factor(bin_width, finest):
+    '''
+    Number of finest bins that make up one bin of bin_width, if bin_width is a
+    multiple of the finest width and its bins share the same edges (else None).
+    '''
+    factor = int(round(bin_width / finest))
+    if (factor >= 1 and math.isclose(factor*finest, bin_width)
+        and decimal_places(bin_width) <= decimal_places(finest)):
+        return factor
+    return None
+
+def regroup_histogram(first_bin, counts, factor):
+    '''
+    Add up the counts of a histogram in groups of factor bins, to get the
+    histogram of a bin width factor times larger.
+    '''
+    coarse = np.arange(first_bin, first_bin+len(counts)) // factor
+    if len(coarse) == 0:
+        return 0, counts
+    return int(coarse[0]), np.bincount(coarse - coarse[0], weights=counts).astype(np.int64)
+
+def model_histogram(first_bin, counts, bin_width, slope_points, smooth_points, outfile):
+    '''
+    Make the DMHistogram for one combination of parameters, calculate its
+    derivatives and write it. Return a summary of the histogram.
+    '''
+    bins_df = histogram_table(first_bin, counts, bin_width)
+    # calculate derivatives
+    bins_df = first_derivative(bins_df, #does 1st smoothing pass and 2nd normal pass
+                               slope_points//2,
+                               smooth_points//2)
+    bins_df = second_derivative(bins_df,
+                                slope_points//2,
+                                smooth_points//2)
+    bins_df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    return [bin_width, slope_points, smooth_points, len(bins_df),
+            bins_df['count'].max(), bins_df['slope1'].max(), outfile]
+
+def parameter_sweep(infiles, infile, bins_list, slope_list, smooth_list, n_workers):
+    '''
+    Read the deltamass values once and make one DMHistogram for each
+    combination of bin width, slope points and smooth points. Histograms of
+    widths that are multiples of the finest one are made from the finest
+    histogram instead of binning again.
+    '''
+    logging.info("Reading deltamass values...")
+    deltamass = np.concatenate(list(mapFiles(read_deltamass, infiles, n_workers)))
+    logging.info("Number of PSMs: " + str(len(deltamass)))
+    finest = min(bins_list)
+    histograms = {finest: deltamass_histogram(deltamass, finest)}
+    if len(histograms[finest][1]) == 0:
+        no_psms()
+    for bin_width in bins_list:
+        if bin_width in histograms:
+            continue
+        factor = width_factor(bin_width, finest)
+        if factor:
+            histograms[bin_width] = regroup_histogram(*histograms[finest], factor)
+        else:
+            histograms[bin_width] = deltamass_histogram(deltamass, bin_width)
+    del deltamass
+    combinations = list(itertools.product(bins_list, slope_list, smooth_list))
+    logging.info("Generating " + str(len(combinations)) + " DMHistograms...")
+    outfiles = [infile[:-4] + '_bins' + str(b) + '_slope' + str(p) + '_smooth' + str(s) + '_DMHistogram.txt'
+                for b, p, s in combinations]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        summary = executor.map(model_histogram, [histograms[b][0] for b, p, s in combinations],
+                                                [histograms[b][1] for b, p, s in combinations],
+                                                [b for b, p, s in combinations],
+                                                [p for b, p, s in combinations],
+                                                [s for b, p, s in combinations],
+                                                outfiles)
+    summary = pd.DataFrame(list(summary), columns=['bins', 'slope_points', 'smooth_points', 'n_bins',
+                                                   'max_count', 'max_slope1', 'DMHistogram'])
+    outfile = infile[:-4] + '_Sweep.txt'
+    summary.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    logging.info("Summary written to " + outfile)
+
 #################
 # Main function #
 #################
@@ -170,41 +329,51 @@ def main(args):
     Main function
     '''
     
-    #Main variables
-    bins = float(config._sections['PeakModeller']['bins'])
-    slope_points = int(config._sections['PeakModeller']['slope_points'])
-    smooth_points = int(config._sections['PeakModeller']['smooth_points'])
-    
     logging.info("Reading input file list...")
     with open(args.infile) as f:
         infiles = f.readlines()
     infiles = [x.strip() for x in infiles] # remove whitespace
     
-    logging.info("Concat input files...")
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:            
-        df = executor.map(concatInfiles, infiles)
-    df = pd.concat(df)
-    df.reset_index(drop=True, inplace=True)
+    if args.sweep:
+        bins_list = [float(x) for x in config._sections['PeakModeller']['bins'].split(',')]
+        slope_list = [int(x) for x in config._sections['PeakModeller']['slope_points'].split(',')]
+        smooth_list = [int(x) for x in config._sections['PeakModeller']['smooth_points'].split(',')]
+        parameter_sweep(infiles, args.infile, bins_list, slope_list, smooth_list, args.n_workers)
+        logging.info("Peak Modelling finished")
+        return
+    
+    #Main variables
+    bins = float(config._sections['PeakModeller']['bins'])
+    slope_points = int(config._sections['PeakModeller']['slope_points'])
+    smooth_points = int(config._sections['PeakModeller']['smooth_points'])
+    dmtable = int(config._sections['PeakModeller']['dmtable'])
+    table_columns = [c.strip() for c in config._sections['PeakModeller']['dmtable_columns'].split(',') if c.strip()]
+    if table_columns and 'cal_dm_mh' not in table_columns:
+        table_columns.append('cal_dm_mh')
+    
+    if dmtable:
+        # write DMtable (input for PeakSelector) file by file, a few files in memory at a time
+        logging.info("Reading input files, counting PSMs by bin and writing DMTable...")
+        if table_columns:
+            logging.info("DMTable columns: " + ", ".join(table_columns))
+        writer = TableWriter(outName(args.infile, '_DMTable', args.out_format))
+        histograms = []
+        for table, first_bin, counts in mapFiles(file_histogram, infiles, args.n_workers,
+                                                 bins, table_columns or None):
+            writer.write(table)
+            histograms.append((first_bin, counts))
+        writer.close()
+    else:
+        logging.info("Reading input files and counting PSMs by bin...")
+        histograms = list(mapFiles(file_counts, infiles, args.n_workers, bins))
 
     logging.info("Generating DMHistogram...")
-    # make bins
-    df, bins_df = generate_histogram(df, bins)
-    # calculate derivatives
-    #grouped_bins_df = bins_df.groupby(['bin'])
-    bins_df = first_derivative(bins_df, #does 1st smoothing pass and 2nd normal pass
-                               slope_points//2,
-                               smooth_points//2)  
-    bins_df = second_derivative(bins_df,
-                                slope_points//2,
-                                smooth_points//2)
-        # check which bins pass
-    logging.info("Writing output files...")
+    # add up the histograms of all files
+    first_bin, counts = merge_histograms(histograms)
+    del histograms
     # write DMhistogram
     outfile = args.infile[:-4] + '_DMHistogram.txt'
-    bins_df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
-    # write DMtable (input for PeakSelector)
-    outfile = args.infile[:-4] + '_DMTable.txt'
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    model_histogram(first_bin, counts, bins, slope_points, smooth_points, outfile)
     logging.info("Peak Modelling finished")
 
 if __name__ == '__main__':
@@ -226,10 +395,14 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config', default=defaultconfig, help='Path to custom config.ini file')
     # TODO: output file path
 
-    parser.add_argument('-b', '--bins', help='Width of the bins')
-    parser.add_argument('-p', '--slope_points', help='Number of points (bins) to use for slope calculation')
-    parser.add_argument('-s', '--smooth_points', help='Number of points (bins) to use for smoothing')
+    parser.add_argument('-b', '--bins', help='Width of the bins (comma-separated list in sweep mode)')
+    parser.add_argument('-p', '--slope_points', help='Number of points (bins) to use for slope calculation (comma-separated list in sweep mode)')
+    parser.add_argument('-s', '--smooth_points', help='Number of points (bins) to use for smoothing (comma-separated list in sweep mode)')
+    parser.add_argument('-t', '--dmtable', help='Write DMTable, 0=no 1=yes')
+    parser.add_argument('-tc', '--dmtable_columns', help='Comma-separated list of columns to write in the DMTable (default: all)')
+    parser.add_argument('-sw', '--sweep', action='store_true', help='Make one DMHistogram for each combination of bins, slope_points and smooth_points')
 
+    parser.add_argument('-of', '--out_format', choices=['txt', 'feather', 'parquet'], default=None, help='Format of the DMTable output file (default: txt)')
     parser.add_argument('-w',  '--n_workers', type=int, default=4, help='Number of threads/n_workers (default: %(default)s)')    
     parser.add_argument('-v', dest='verbose', action='store_true', help="Increase output verbosity")
     args = parser.parse_args()
@@ -246,6 +419,12 @@ if __name__ == '__main__':
     if args.smooth_points is not None:
         config.set('PeakModeller', 'smooth_points', str(args.smooth_points))
         config.set('Logging', 'create_ini', '1')
+    if args.dmtable is not None:
+        config.set('PeakModeller', 'dmtable', str(args.dmtable))
+        config.set('Logging', 'create_ini', '1')
+    if args.dmtable_columns is not None:
+        config.set('PeakModeller', 'dmtable_columns', str(args.dmtable_columns))
+        config.set('Logging', 'create_ini', '1')
     # if something is changed, write a copy of ini
     if config.getint('Logging', 'create_ini') == 1:
         with open(os.path.dirname(args.infile) + '/SHIFTS.ini', 'w') as newconfig:
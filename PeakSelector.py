@@ -17,13 +17,13 @@ import sys
 import argparse
 import configparser
 import logging
-import re
 import pandas as pd
 import numpy as np
+from TableIO import readTable
 pd.options.mode.chained_assignment = None  # default='warn'
 
 def readHistogram(infile):
-    df_hist = pd.read_csv(args.infile, sep="\t", float_precision='high')
+    df_hist = readTable(infile)
     df_hist = df_hist.dropna() # Remove rows with missing values (will always have some in beginning and end)
     df_hist.reset_index(drop=True, inplace=True)
     return df_hist
@@ -49,93 +49,74 @@ def peakSelector(df_hist, slope, frequency, apex_points):
     
     ### MARK BINS ###
     
-    df_hist['previous'] = df_hist['slope1'].shift()
-    df_hist['next'] = df_hist['slope1'].shift(-1)
+    slope1 = df_hist['slope1'].to_numpy(dtype=np.float64)
+    previous = np.concatenate([[np.nan], slope1[:-1]])
+    following = np.concatenate([slope1[1:], [np.nan]])
     
     # Mark apex bins
-    df_hist['apex'] = df_hist.apply(lambda x: 1 if (x['slope1']<0 and x['previous']>0)
-                                                else 0, axis = 1)
+    apex = (slope1 < 0) & (previous > 0)
     
     ### TEST ###
-    df_hist['peak_begin'] = df_hist.apply(lambda x: 1 if (abs(x['slope1'])>slope and x['slope1']>0 and abs(x['previous'])<slope) #beginning
-                                                else 0, axis = 1)
-    df_hist['peak_end'] = df_hist.apply(lambda x: 1 if (abs(x['slope1'])>slope and x['slope1']<0 and abs(x['next'])<slope) #end
-                                        else 0, axis = 1)
-    df_hist['slope_threshold'] = df_hist.apply(lambda x: 1 if (x['peak_begin'] == 1 and abs(x['slope1'])>slope)
-                                                           or (x['peak_end'] == 1 and abs(x['slope1'])>slope)
-                                                           else 0, axis = 1)
-            
-    df_hist['peak_group'] = 0
-    begin_list = df_hist.index[(df_hist['peak_begin'] == 1) & (df_hist['slope_threshold'] == 1)].tolist()
-    for i in begin_list:
-        around_apex = [i]
-        new_index = i
-        in_peak = True
-        while in_peak == True:
-            new_index += 1
-            if new_index >= len(df_hist)-1:
-                in_peak = False
-                break
-            if df_hist.loc[new_index]['peak_begin'] != 0 and df_hist.loc[new_index]['slope_threshold'] != 0:
-                in_peak == False
-                break
-            if df_hist.loc[new_index]['peak_end'] != 0 and df_hist.loc[new_index]['slope_threshold'] != 0: #TODO: we never reach here?
-                in_peak == False
-                around_apex.extend(range(i, new_index+1))
-                break
-        for k in around_apex:
-            df_hist.at[k, 'peak_group'] = 1
-            
-    df_hist = df_hist.drop('previous', 1)
-    df_hist = df_hist.drop('next', 1)
+    peak_begin = (np.abs(slope1) > slope) & (slope1 > 0) & (np.abs(previous) < slope) #beginning
+    peak_end = (np.abs(slope1) > slope) & (slope1 < 0) & (np.abs(following) < slope) #end
+    
+    # A peak goes from its beginning to the next end, unless another beginning
+    # comes first (the last bin is never checked)
+    begin_index = np.flatnonzero(peak_begin)
+    event_index = np.flatnonzero((peak_begin | peak_end)[:len(slope1)-1])
+    next_event = np.append(event_index, -1)[np.searchsorted(event_index, begin_index, side='right')]
+    closed = (next_event >= 0) & peak_end[next_event]
+    peak_stop = np.where(closed, next_event, begin_index)
+    peak_group = np.zeros(len(slope1)+1, dtype=np.int64)
+    np.add.at(peak_group, begin_index, 1)
+    np.add.at(peak_group, peak_stop+1, -1)
+    peak_group = np.cumsum(peak_group)[:-1] > 0
     
     ### FILTER PEAKS ###
     
-    grouped_hist = df_hist.groupby((df_hist['peak_group'].shift() != df_hist['peak_group']).cumsum())
+    # runs of consecutive bins marked as peaks
+    run_edges = np.diff(np.concatenate([[0], peak_group.astype(np.int8), [0]]))
+    run_starts = np.flatnonzero(run_edges == 1)
+    run_stops = np.flatnonzero(run_edges == -1)
+    counts = df_hist['count'].to_numpy()
+    midpoints = df_hist['midpoint'].to_numpy()
     
-    apex_bin_list = []
-    for position, peak in grouped_hist:
-        peak_df = peak
-        if all(peak_df['peak_group'] != 0): #groups marked as peaks
-            if any(peak_df['count'] >= frequency): #TODO fix for several apexes ## HERE I STOPPED
-                if 1 in peak_df['apex'].value_counts().index and peak_df['apex'].value_counts()[1] == 1: #one apex
-                    for i in peak_df['midpoint'].loc[peak_df['apex'] == 1]:
-                        apex_bin_list.append(i)
-                if 1 in peak_df['apex'].value_counts().index and peak_df['apex'].value_counts()[1] > 1: #more than one potential apex
-                    #apex_bin_list.extend(multipleApex(list(peak_df['midpoint'].loc[peak_df['apex'] == 1]), apex_massdiff))
-                    apex_bin_list.extend(firstAndLastApex(list(peak_df['midpoint'].loc[peak_df['apex'] == 1])))
+    apex_bin_list = [] # position of the apex bins
+    for start, stop in zip(run_starts, run_stops):
+        if (counts[start:stop] >= frequency).any(): #TODO fix for several apexes
+            apex_bins = start + np.flatnonzero(apex[start:stop])
+            if len(apex_bins) == 1: #one apex
+                apex_bin_list.append(apex_bins[0])
+            elif len(apex_bins) > 1: #more than one potential apex
+                #apex_bin_list.extend(multipleApex(list(midpoints[apex_bins]), apex_massdiff))
+                apex_bin_list.extend(firstAndLastApex(list(apex_bins)))
 
     ### CALCULATE APEX ###
-    apex_list = []
     before = apex_points//2
     after = (apex_points//2) - 1
-    for apex_bin in apex_bin_list:
-        bin_subset = df_hist.loc[df_hist['midpoint'] == apex_bin]
-        try:
-            for i in range(1, before + 1):
-                bin_subset = bin_subset.append(df_hist.loc[df_hist['midpoint'].shift(-i) == apex_bin], ignore_index=True)
-            for i in range(1, after + 1):
-                bin_subset = bin_subset.append(df_hist.loc[df_hist['midpoint'].shift(i) == apex_bin], ignore_index=True)
-            bin_subset.sort_values(by=['midpoint'], inplace=True)
-            bin_subset.reset_index(drop=True, inplace=True)
-            apex = interpolateApex(bin_subset)
-            apex_list.append(apex)
-        except:
-            logging.info("Not enough bins to interpolate apex at" + str(apex_bin))
+    apex_bins = np.array(apex_bin_list, dtype=np.int64)
+    windows = apex_bins[:, None] + np.arange(-before, max(after, 0) + 1)
+    inside = ((windows >= 0) & (windows < len(midpoints))).all(axis=1)
+    apex_list = np.full(len(apex_bins), np.nan)
+    apex_list[inside] = interpolateApex(midpoints[windows[inside]], slope1[windows[inside]])
+    # windows cut by the ends of the histogram use the bins available
+    for i in np.flatnonzero(~inside):
+        window = windows[i][(windows[i] >= 0) & (windows[i] < len(midpoints))]
+        apex_list[i] = interpolateApex(midpoints[window], slope1[window])[0]
+    for apex_bin in midpoints[apex_bins[~np.isfinite(apex_list)]]:
+        logging.info("Not enough bins to interpolate apex at " + str(apex_bin))
     
-    return apex_list
+    return list(apex_list[np.isfinite(apex_list)])
     
 def filterPeaks(df_hist, slope, frequency):
     '''
     Find peaks that are above the thresholds for slope and PSMs.
     '''
     # TODO: allow specify slope and count columns in INI?
-    df_hist['apex'] = 0
-    df_hist['previous'] = df_hist['slope1'].shift()
-    df_hist['next'] = df_hist['slope1'].shift(-1)
-    df_hist['apex'] = df_hist.apply(lambda x: 1 if (x['slope1']<0 and x['previous']>0) or (x['slope1']>0 and x['next']<0) else 0, axis = 1)
-    df_hist = df_hist.drop('previous', 1)
-    df_hist = df_hist.drop('next', 1)
+    previous = df_hist['slope1'].shift()
+    following = df_hist['slope1'].shift(-1)
+    df_hist['apex'] = (((df_hist['slope1'] < 0) & (previous > 0))
+                       | ((df_hist['slope1'] > 0) & (following < 0))).astype(int)
     
     df_hist1 = df_hist[abs(df_hist['slope1']) >= slope] # keep those whose slope1 is over the threshold
     df_hist2 = df_hist[df_hist['apex'] == 1] # keep those where there is a sign change
@@ -155,78 +136,68 @@ def filterPeaks(df_hist, slope, frequency):
 
 def parseInterval(bins_df):
     '''
-    Read 'bin' column as an interval.
+    Read 'bin' column as an interval, adding its limits as 'left' and 'right' columns.
     '''
-    for i in range(0, len(bins_df)):
-        to_interval = bins_df.loc[i, 'bin']
-        left = float(re.findall(r'-?\d+\.\d+', to_interval)[0]) 
-        right = float(re.findall(r'-?\d+\.\d+', to_interval)[1])
-        bins_df.loc[i, 'bin'] = pd.Interval(left, right, closed='right')
+    limits = bins_df['bin'].astype(str).str.extract(r'(-?\d+\.\d+).*?(-?\d+\.\d+)').astype(np.float64)
+    bins_df['left'] = limits[0]
+    bins_df['right'] = limits[1]
     return bins_df
 
-def areValid(intervals):
+def areValid(slope1, left, right, apex_points):
     '''
-    Check whether intervals in a list are contiguous, have a change in
-    sign of the slope, and the central point is the closest to 0.
+    Check for each window of apex_points//2*2+1 bins whether its intervals are
+    contiguous, have a change in sign of the slope, and the central point is
+    the closest to 0. Windows are taken in order, centered from bin
+    apex_points//2 on.
     '''
-    cont = 0
-    slope1_list = intervals['slope1'].tolist()
-    zero_bin = min(slope1_list, key=abs)
-    zero_index = slope1_list.index(zero_bin)
-    
-    first_half = slope1_list[:len(slope1_list)//2]
-    second_half = slope1_list[(len(slope1_list)//2)+1:]
-    if all([x > 0 for x in first_half]) and all([x < 0 for x in second_half]):
-        if zero_index == len(intervals)//2: # Central point is closest to 0
-           if (intervals.loc[zero_index, 'slope1'] >= 0 and intervals.loc[zero_index+1, 'slope1'] < 0) or (intervals.loc[zero_index, 'slope1'] <= 0 and intervals.loc[zero_index-1, 'slope1'] > 0): # Change in sign  
-               bin_list = intervals['bin'].tolist()
-               cont = 1
-               for i in range(1, len(bin_list)):
-                   if bin_list[i-1].right != bin_list[i].left: # Not contiguous
-                       cont = 0
-    if cont == 0:
-        return False
-    else:
-        return True
+    half = apex_points//2
+    windows = np.lib.stride_tricks.sliding_window_view(slope1, 2*half+1)
+    first_half = (windows[:, :half] > 0).all(axis=1)
+    second_half = (windows[:, half+1:] < 0).all(axis=1)
+    central = np.argmin(np.abs(windows), axis=1) == half # Central point is closest to 0
+    sign_change = (((windows[:, half] >= 0) & (windows[:, half+1] < 0))
+                   | ((windows[:, half] <= 0) & (windows[:, half-1] > 0))) # Change in sign
+    contiguous = np.lib.stride_tricks.sliding_window_view(right[:-1] == left[1:], 2*half).all(axis=1)
+    return first_half & second_half & central & sign_change & contiguous
     
-def interpolateApex(bin_subset):
-    x_list = bin_subset['midpoint'].tolist()
-    y_list = bin_subset['slope1'].tolist()
-    sum1, sum2 = 0, 0
-    for i in range(len(x_list)):
-        sum1 += (x_list[i] - np.mean(x_list)) * (y_list[i] - np.mean(y_list))
-        sum2 += (x_list[i] - np.mean(x_list)) ** 2
-    working_slope = sum1 / sum2
-    intercept = np.mean(y_list) - working_slope*np.mean(x_list)
-    apex = -intercept / working_slope # x where y=0
+def interpolateApex(x, y):
+    '''
+    Interpolate the apex of each peak (one peak per row of x and y) as the
+    point where the linear regression line through its bins crosses zero.
+    Sums are added in the same order as a loop over the bins.
+    '''
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    x_mean = np.ascontiguousarray(x).mean(axis=1)
+    y_mean = np.ascontiguousarray(y).mean(axis=1)
+    sum1 = np.zeros(len(x))
+    sum2 = np.zeros(len(x))
+    for i in range(x.shape[1]):
+        x_dev = x[:, i] - x_mean
+        sum1 += x_dev * (y[:, i] - y_mean)
+        sum2 += x_dev ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        working_slope = sum1 / sum2
+        intercept = y_mean - working_slope*x_mean
+        apex = -intercept / working_slope # x where y=0
     return apex
 
 def peakApex(bins_df, apex_points):
     '''
     Calculate apex for each peak.
     '''
-    apex_list = []
-    # for i in range(1, len(bins_df)):
-    #     if bins_df.loc[i, 'slope2'] is not None:
-    #         i1 = bins_df.loc[i-1, 'bin'] # TODO parse interval
-    #         i2 = bins_df.loc[i, 'bin']
-    #         # Check intervals are consecutive, and there is a change in sign of slope2
-    #         if i1.right == i2.left and bins_df.loc[i, 'slope2'] < 0 and bins_df.loc[i-1, 'slope2'] >= 0:
-    #             peak = pd.Series([bins_df.loc[i-1, 'midpoint'], np.nan, bins_df.loc[i, 'midpoint']],
-    #                               index=[bins_df.loc[i-1, 'slope2'], 0, bins_df.loc[i, 'slope2']])
-    #             peak = peak.interpolate(method='index')
-    #             apex_list.append(peak[0])
-    for i in range(apex_points//2, len(bins_df)-apex_points//2):
-        # Check there is a change of sign
-        intervals = []
-        for j in range(i-apex_points//2, i+apex_points//2+1):
-            intervals.append(bins_df.loc[j])
-        intervals = pd.DataFrame(intervals)
-        intervals.reset_index(drop=True, inplace=True)
-        if areValid(intervals):
-            peak = interpolateApex(intervals)
-            apex_list.append(peak)
-    return apex_list
+    half = apex_points//2
+    slope1 = bins_df['slope1'].to_numpy(dtype=np.float64)
+    if len(slope1) < 2*half+1:
+        return []
+    valid = areValid(slope1,
+                     bins_df['left'].to_numpy(dtype=np.float64),
+                     bins_df['right'].to_numpy(dtype=np.float64),
+                     apex_points)
+    midpoint_windows = np.lib.stride_tricks.sliding_window_view(bins_df['midpoint'].to_numpy(dtype=np.float64), 2*half+1)
+    slope1_windows = np.lib.stride_tricks.sliding_window_view(slope1, 2*half+1)
+    apex_list = interpolateApex(midpoint_windows[valid], slope1_windows[valid])
+    return list(apex_list)
 
 def main(args):
     '''
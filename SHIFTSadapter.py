@@ -13,9 +13,11 @@ __status__ = "Development"
 
 # import modules
 import argparse
+import os
 import logging
 import pandas as pd
 import sys
+from TableIO import writeTable, outName
 
 def main(args):
     '''
@@ -33,8 +35,8 @@ def main(args):
     logging.info('Database: ' + first_line[3])
     
     logging.info('Writing output file')
-    outfile = args.infile[:-4] + '_SHIFTS.txt'
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(args.infile, '_SHIFTS', args.out_format)
+    writeTable(df, outfile)
     
     logging.info('Done')
     
@@ -51,16 +53,17 @@ if __name__ == '__main__':
         ''')
     
     parser.add_argument('-i', '--infile', required=True, help='Path to input file')
+    parser.add_argument('-of', '--out_format', choices=['txt', 'feather', 'parquet'], default='txt', help='Format of the output file (default: %(default)s)')
 
     parser.add_argument('-v', dest='verbose', action='store_true', help='Increase output verbosity')
     args = parser.parse_args() 
 
     # logging debug level. By default, info level
-    log_file = args.infile[:-4] + '_log.txt'
-    log_file_debug = args.infile[:-4] + '_log_debug.txt'
+    log_file = os.path.splitext(args.infile)[0] + '_log.txt'
+    log_file_debug = os.path.splitext(args.infile)[0] + '_log_debug.txt'
     # Logging debug level. By default, info level
-    log_file = args.infile[:-4] + '_log.txt'
-    log_file_debug = args.infile[:-4] + '_log_debug.txt'
+    log_file = os.path.splitext(args.infile)[0] + '_log.txt'
+    log_file_debug = os.path.splitext(args.infile)[0] + '_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(message)s',
@@ -23,6 +23,8 @@ import os
 import logging
 from pathlib import Path
 import tkinter as tk
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from TableIO import readTable, writeTable, outName
 
 
 
@@ -35,7 +37,7 @@ def readInfile(infile):
     Read input file to dataframe.
     '''
     
-    df = pd.read_csv(infile, sep="\t", float_precision='high',low_memory=False)
+    df = readTable(infile)
     return df
 
 def DM0Solver( Theo_mh,Exp_mh,seq,Error,dic_DM0):
@@ -153,13 +155,12 @@ def main(solverconfig,infile):
     # write outputfile
     logging.info("Writing output file")
 
-    outfilename = infile1[:-4]+output_file_suffix
-    outfile= outfilename+".txt"
+    outfile = outName(infile1, output_file_suffix)
     try:
         remove("outfile")
     except:
         None
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    writeTable(df, outfile)
 
     logging.info('end script')
 
@@ -203,8 +204,8 @@ if __name__ == '__main__':
             config.write(newconfig)
         
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + '_DM0Solved_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + '_DM0Solved_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + '_DM0Solved_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_DM0Solved_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level = logging.DEBUG,
                             format = '%(asctime)s - %(levelname)s - %(message)s',
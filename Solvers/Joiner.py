@@ -21,6 +21,8 @@ import argparse
 import os
 import logging
 from pathlib import Path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from TableIO import readTable, writeTable, outName
 
 
 
@@ -33,7 +35,7 @@ def readInfile(infile):
     Read input file to dataframe.
     '''
     
-    df = pd.read_csv(infile, sep="\t", float_precision='high',low_memory=False)
+    df = readTable(infile)
     return df
 
 
@@ -97,9 +99,8 @@ def main(solverconfig,infile):
    
 
     logging.info("Writing output file")
-    outfilename = infile[:-4]+Output_file_suffix
-    outfile = outfilename + ".txt"
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(infile, Output_file_suffix)
+    writeTable(df, outfile)
 
 
 
@@ -135,8 +136,8 @@ if __name__ == '__main__':
     config.read(args.config)
 
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + '_Joiner_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + '_Joiner_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + '_Joiner_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_Joiner_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level = logging.DEBUG,
                             format = '%(asctime)s - %(levelname)s - %(message)s',
@@ -23,6 +23,8 @@ import argparse
 import os
 import logging
 from pathlib import Path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from TableIO import readTable, writeTable, outName
 
 
 
@@ -35,7 +37,7 @@ def readInfile(infile):
     Read input file to dataframe.
     '''
     
-    df = pd.read_csv(infile, sep="\t", float_precision='high',low_memory=False)
+    df = readTable(infile)
     return df
 
 
@@ -166,10 +168,8 @@ def main(solverconfig,infile,modsfileuser,modsfileUnimod):
     # write outputfile
     logging.info("Writing output file")
 
-    outfilename = infile[:-4]+output_file_suffix
-
-    outfile= outfilename+".txt"
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(infile, output_file_suffix)
+    writeTable(df, outfile)
   
 
     logging.info('end script')
@@ -222,8 +222,8 @@ if __name__ == '__main__':
             config.write(newconfig)
         
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + '_Sticker_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + '_Sticker_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + '_Sticker_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_Sticker_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level = logging.DEBUG,
                             format = '%(asctime)s - %(levelname)s - %(message)s',
@@ -31,6 +31,9 @@ import os
 import logging
 from pathlib import Path
 import tkinter as tk
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MassCache import residueTable, neutralMass
+from TableIO import readTable, writeTable, outName
 
 
 
@@ -43,29 +46,40 @@ def readInfile(infile):
     '''    
     Read input file to dataframe.
     '''
-    df = pd.read_csv(infile, sep="\t", float_precision='high', low_memory=False)
+    df = readTable(infile)
     return df
 
 
 
 
 
-def theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,Hydrogen,O2,decnum):
+def theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,Hydrogen,O2,decnum,mass_table=None,mass_cache=None):
     
     """
     Theoretical mass is calculated taking into account fix modifications, label and subseq. This funtions returns theoretical
     mass fix modifications positions and the subsequence adding fix modifications.
+    The residue masses (mass_table) are made from dic_aa, dic_mod and label_mass if not given, and the subsequence
+    masses are saved in mass_cache.
     """
+    if mass_table is None:
+        mass_table = trunk_mass_table(dic_aa,dic_mod,label_mass)
+    if mass_cache is None:
+        mass_cache = {}
     decnum = int(decnum.replace("f","").replace(".",""))
     H20 = 2*Hydrogen+O2
     pattern = "[a-z]"
     
-    sumall = 0
     newsequence = []
     c = 0
     mods_position = []
     
-    # For each amino acid, depending on which is its condition (fix modifications, label, N-termina), mass is added  
+    # Mass is calculated once per subsequence (N-terminal position is in lower case) and saved in mass_cache
+    subseq_key = "".join(subseq)
+    sumall = mass_cache.get(subseq_key)
+    if sumall is None:
+        sumall = neutralMass([subseq_key], mass_table, H20, mass_cache, strict=True)[0]
+    
+    # For each amino acid, depending on which is its condition (fix modifications, label, N-termina), the sequence is annotated  
     for aa in subseq:
         c = c+1
         
@@ -73,37 +87,27 @@ def theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,H
             aa = aa.upper()
             
             if aa in dic_mod.keys(): # If it has a fix modification
-                sumall = sumall+float(dic_mod[aa][1])
-                sumall = sumall+label_mass
                 newsequence.append(dic_mod[aa][0]+"TMT")
                 mods_position.append(str(c)+"_"+aa+"_"+str(label_mass)+"_N")
                 mods_position.append(str(c)+"_S_"+str(dic_mod[aa][2]))  
                     
             else: # If it has not a fix modification
-          
-                sumall = sumall+float(dic_aa[aa]) 
-                sumall = sumall+label_mass
-                cosa = float(dic_aa[aa])+float(label_mass)
                 newsequence.append(aa+"-TMT")
                 mods_position.append(str(c)+"_"+aa+"_"+str(label_mass)+"_N")
                 
         else: # If it has not N-terminal position
          
             if aa in dic_mod.keys(): # If it has a fix modification
-    
-                sumall = sumall+float(dic_mod[aa][1])
                 newsequence.append(dic_mod[aa][0])
                 mods_position.append(str(c)+"_S_"+str(dic_mod[aa][2]))
    
                 
             else: # If it has not a fix modification
-                
-                sumall = sumall+dic_aa[aa]
                 newsequence.append(aa)
               
                 
     mods_position = ",".join(mods_position)
-    sumall = sumall+H20+Mproton 
+    sumall = sumall+Mproton 
     sumall = round(sumall,decnum)
 
     return sumall,newsequence,mods_position
@@ -112,6 +116,24 @@ def theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,H
 
 
 
+def trunk_mass_table(dic_aa,dic_mod,label_mass):
+    
+    """
+    Mass of each residue taking into account fix modifications. N-terminal residues (lower case) also carry the label mass.
+    """
+    residue_masses = {}
+    for aa in dic_aa:
+        if aa in dic_mod.keys(): # If it has a fix modification
+            residue_masses[aa] = float(dic_mod[aa][1])
+        else:
+            residue_masses[aa] = float(dic_aa[aa])
+        residue_masses[aa.lower()] = residue_masses[aa]+label_mass
+    return residueTable(residue_masses)
+
+
+
+
+
 def tag(seq,subseq):
     
     """
@@ -225,13 +247,13 @@ def Obtain_values(seq,MasterProtein_column,dic_fasta):
 
 
 
-def best_combination(subseq,Exp_Mh,cont,j,Error,label_mass,dic_mod,selectedaa,dic_CombList,dic_aa,decnum,Mproton,Hydrogen,O2, distanceDMsub,distanceDM,x):
+def best_combination(subseq,Exp_Mh,cont,j,Error,label_mass,dic_mod,selectedaa,dic_CombList,dic_aa,decnum,Mproton,Hydrogen,O2, distanceDMsub,distanceDM,x,mass_table=None,mass_cache=None):
     """
     Best_Combinations function returns the combinations of "Combination list" that give rise to an error less than or equal to the allowed and 
     variables that indicate  whether TrunkSolver should stop extending the length of the sequence being analyzed
     """
     # New subsequence mass is calulated by theoretical_mh_by_hand function
-    ther,newsequence,mods_position = theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,Hydrogen,O2,decnum) 
+    ther,newsequence,mods_position = theoretical_mh_by_hand(subseq,label_mass,dic_mod,dic_aa,selectedaa,Mproton,Hydrogen,O2,decnum,mass_table,mass_cache) 
     
     # initial parameters are set 
     ngreater = 0
@@ -288,7 +310,7 @@ def best_combination(subseq,Exp_Mh,cont,j,Error,label_mass,dic_mod,selectedaa,di
 
 
 
-def TrunkSolver(seq,dic_seqs,Exp_mh,calibrated_delta_MH,result,Error,dic_aa,dic_CombList,dic_mod,NT_label,selectedaa,decnum,Mproton,Hydrogen,O2,Theo_mh,x):
+def TrunkSolver(seq,dic_seqs,Exp_mh,calibrated_delta_MH,result,Error,dic_aa,dic_CombList,dic_mod,NT_label,selectedaa,decnum,Mproton,Hydrogen,O2,Theo_mh,x,mass_table=None,mass_cache=None):
     
    
     """
@@ -385,7 +407,7 @@ def TrunkSolver(seq,dic_seqs,Exp_mh,calibrated_delta_MH,result,Error,dic_aa,dic_
                         distanceDMsub = distanceDMsub2
                     
                     
-                    minimun_DiffPPM,TrunkSequence,TrunkDM,TrunkLabel,mods_position,Trunk_Label_ppm,j,New_DM, New_Theo_MH = best_combination(subseq,Exp_mh,int(cont),j,Error,float(NT_label),dic_mod,selectedaa,dic_CombList,dic_aa,decnum,Mproton,Hydrogen,O2,distanceDMsub,DMresultposition,x)
+                    minimun_DiffPPM,TrunkSequence,TrunkDM,TrunkLabel,mods_position,Trunk_Label_ppm,j,New_DM, New_Theo_MH = best_combination(subseq,Exp_mh,int(cont),j,Error,float(NT_label),dic_mod,selectedaa,dic_CombList,dic_aa,decnum,Mproton,Hydrogen,O2,distanceDMsub,DMresultposition,x,mass_table,mass_cache)
                     
                     if TrunkSequence != "" and j == "": # if best_combination  function finds a possible solution 
                        
@@ -509,6 +531,8 @@ def main(file,file1,infile1, infilefasta):
             value2 = value+dic_aa[option]
             dic_mod[option[0]] = new_name,value2,value
             
+    mass_table = trunk_mass_table(dic_aa,dic_mod,float(NT_label)) # Residue masses used by theoretical_mh_by_hand
+    mass_cache = {} # Subsequence masses already calculated
     
     
     
@@ -590,7 +614,7 @@ def main(file,file1,infile1, infilefasta):
 
         else:
             dic_seqs,result=Obtain_values(row[Seq_column_name],row[MasterProtein_column_name],dic_fasta)
-            final_TrunkSequence,final_TrunkDM,final_TrunkLabel,final_mods_position,minimun,final_Trunk_Label_ppm,match_number,addition,final_New_DM,final_New_Theo_MH = TrunkSolver(row[Seq_column_name],dic_seqs,row[Exp_mh_column_name],row[Delta_MH_cal_column_name],result,Error,dic_aa,dic_CombList,dic_mod,NT_label,selectedaa,decnum,Mproton,Hydrogen,O2,row[Theo_mh_column_name],x)
+            final_TrunkSequence,final_TrunkDM,final_TrunkLabel,final_mods_position,minimun,final_Trunk_Label_ppm,match_number,addition,final_New_DM,final_New_Theo_MH = TrunkSolver(row[Seq_column_name],dic_seqs,row[Exp_mh_column_name],row[Delta_MH_cal_column_name],result,Error,dic_aa,dic_CombList,dic_mod,NT_label,selectedaa,decnum,Mproton,Hydrogen,O2,row[Theo_mh_column_name],x,mass_table,mass_cache)
 
         
         
@@ -614,9 +638,8 @@ def main(file,file1,infile1, infilefasta):
     # write outputfile
     logging.info("Writing output file")
 
-    outfilename = infile1[:-4]
-    outfile= outfilename+output_file_suffix+".txt"
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(infile1, output_file_suffix)
+    writeTable(df, outfile)
 
 
     logging.info('end script')
@@ -671,8 +694,8 @@ if __name__ == '__main__':
             config.write(newconfig)
         
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + 'TrunkSolver_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + 'TrunkSolver_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + 'TrunkSolver_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + 'TrunkSolver_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(message)s',
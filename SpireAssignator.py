@@ -20,13 +20,14 @@ import os
 import pandas as pd
 from pathlib import Path
 import sys
+from TableIO import readTable, writeTable, outName
 
 def readInfile(infile):
     '''    
     Read input file to dataframe.
     '''
     #df = pd.read_csv(infile, skiprows=1, sep="\t", float_precision='high')
-    df = pd.read_csv(infile, sep="\t", float_precision='high')
+    df = readTable(infile)
     return df
 
 def pickSpires(df, percentage, cometcol, recomcol, outcol, label):
@@ -69,8 +70,8 @@ def main(args):
     
     # Write output file
     logging.info("Writing output file...")
-    outfile = args.infile[:-4] + '_spires.txt'
-    df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+    outfile = outName(args.infile, '_spires')
+    writeTable(df, outfile)
     logging.info("Spire assignation finished.")
 
 if __name__ == '__main__':
@@ -115,8 +116,8 @@ if __name__ == '__main__':
             config.write(newconfig)
 
     # logging debug level. By default, info level
-    log_file = outfile = args.infile[:-4] + '_spires_log.txt'
-    log_file_debug = outfile = args.infile[:-4] + '_spires_log_debug.txt'
+    log_file = outfile = os.path.splitext(args.infile)[0] + '_spires_log.txt'
+    log_file_debug = outfile = os.path.splitext(args.infile)[0] + '_spires_log_debug.txt'
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s - %(levelname)s - %(message)s',
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Module metadata variables
+__author__ = "Andrea Laguillo Gómez"
+__credits__ = ["Andrea Laguillo Gómez", "Jose Rodriguez", "Jesus Vazquez"]
+__license__ = "Creative Commons Attribution-NonCommercial-NoDerivs 4.0 Unported License https://creativecommons.org/licenses/by-nc-nd/4.0/"
+__version__ = "0.0.1"
+__maintainer__ = "Jose Rodriguez"
+__email__ = "andrea.laguillo@cnic.es;jmrodriguezc@cnic.es"
+__status__ = "Development"
+
+# import modules
+import os
+import sys
+import collections
+import concurrent.futures
+import pandas as pd
+
+# Input and output tables of the SHIFTS modules. The format is chosen by the
+# file extension: tab-separated text (default), Feather or Parquet.
+# Feather and Parquet keep the exact float values, are faster to read and write
+# and allow reading only some columns. They need pyarrow.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+FORMATS = {'.feather': 'feather', '.ftr': 'feather', '.parquet': 'parquet', '.pq': 'parquet'}
+EXTENSIONS = {'txt': '.txt', 'feather': '.feather', 'parquet': '.parquet'}
+
+###################
+# Local functions #
+###################
+
+def tableFormat(infile):
+    '''
+    Get the table format from the file extension (text if not Feather or Parquet).
+    '''
+    fmt = FORMATS.get(os.path.splitext(str(infile))[1].lower(), 'txt')
+    if fmt != 'txt' and pa is None:
+        sys.exit("ERROR: pyarrow is needed to read and write " + fmt + " files")
+    return fmt
+
+def outName(infile, suffix, out_format=None):
+    '''
+    Name of an output file: input file name plus suffix, with the extension of
+    the output format (same format as the input file by default).
+    '''
+    if not out_format:
+        out_format = tableFormat(infile)
+    return os.path.splitext(str(infile))[0] + suffix + EXTENSIONS[out_format]
+
+def tableColumns(infile):
+    '''
+    Get the column names of a table without reading it.
+    '''
+    fmt = tableFormat(infile)
+    if fmt == 'feather':
+        return pa.ipc.open_file(pa.memory_map(str(infile))).schema.names
+    if fmt == 'parquet':
+        return pq.read_schema(str(infile)).names
+    return list(pd.read_csv(infile, sep="\t", nrows=0).columns)
+
+def readTable(infile, usecols=None):
+    '''
+    Read a table to dataframe, only the usecols columns if given.
+    '''
+    fmt = tableFormat(infile)
+    if fmt == 'feather':
+        return pd.read_feather(infile, columns=usecols)
+    if fmt == 'parquet':
+        return pd.read_parquet(infile, columns=usecols)
+    return pd.read_csv(infile, sep="\t", usecols=usecols, float_precision='high', low_memory=False)
+
+def readTableChunks(infile, chunksize, usecols=None):
+    '''
+    Read a table in chunks of (at most) chunksize rows.
+    '''
+    fmt = tableFormat(infile)
+    if fmt == 'feather':
+        reader = pa.ipc.open_file(pa.memory_map(str(infile)))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if usecols is not None:
+                batch = batch.select(usecols)
+            for start in range(0, batch.num_rows, chunksize):
+                yield batch.slice(start, chunksize).to_pandas()
+    elif fmt == 'parquet':
+        for batch in pq.ParquetFile(str(infile)).iter_batches(batch_size=chunksize, columns=usecols):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(infile, sep="\t", usecols=usecols, float_precision='high',
+                               chunksize=chunksize)
+
+def arrowSafe(df, categories=True):
+    '''
+    Interval columns (histogram bins) are written as text, as in text tables.
+    Categorical columns are written as plain values if not categories.
+    '''
+    for column in df.columns:
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            if not categories:
+                df = df.assign(**{column: df[column].astype(dtype.categories.dtype)})
+            dtype = dtype.categories.dtype
+        if isinstance(dtype, pd.IntervalDtype):
+            df = df.assign(**{column: df[column].astype(str)})
+    return df
+
+def writeTable(df, outfile):
+    '''
+    Write a dataframe to a table file.
+    '''
+    fmt = tableFormat(outfile)
+    if fmt == 'feather':
+        arrowSafe(df).reset_index(drop=True).to_feather(outfile)
+    elif fmt == 'parquet':
+        arrowSafe(df).to_parquet(outfile, index=False)
+    else:
+        df.to_csv(outfile, index=False, sep='\t', encoding='utf-8')
+
+def mapFiles(function, infiles, n_workers, *args):
+    '''
+    Call function(infile, *args) for each input file in a pool of threads and
+    yield the results in the order of the files. Table readers release the GIL
+    while parsing, so files are read in parallel and the tables reach the
+    caller without being pickled. At most n_workers results are kept waiting.
+    For stages that bring the tables of several files into one process
+    (PeakModeller). Stages that process each file on its own in a worker
+    (PeakAssignator -l) do not send tables between processes.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = collections.deque()
+        for infile in infiles:
+            futures.append(executor.submit(function, infile, *args))
+            if len(futures) > n_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+class TableWriter():
+    '''
+    Write a table chunk by chunk, with the columns of the first chunk. Later
+    chunks are reindexed to them: columns are put in the same order, missing
+    columns are left empty and other columns are dropped. Categorical columns
+    are written as plain values, as their categories can change from one chunk
+    to the next. In Feather and Parquet files the type of each column is taken
+    from the first chunk where it has values (text if it never has), keeping up
+    to BUFFER_ROWS rows in memory until then. All chunks are cast to these types.
+    '''
+    BUFFER_ROWS = 1000000
+
+    def __init__(self, outfile):
+        self.outfile = str(outfile)
+        self.format = tableFormat(outfile)
+        self.writer = None
+        self.schema = None
+        self.columns = None
+        self.types = {}
+        self.pending = []
+        self.first = True
+
+    def castTable(self, df):
+        '''
+        Convert a chunk to an Arrow table with the schema of the file.
+        Columns are cast to the type of the file, or written as text if it is text.
+        '''
+        arrays = []
+        for field in self.schema:
+            column = df[field.name]
+            try:
+                array = pa.array(column, from_pandas=True).cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                if not pa.types.is_string(field.type):
+                    raise ValueError("Column '" + field.name + "' cannot be written as " +
+                                     str(field.type) + " in " + self.outfile)
+                array = pa.array([None if pd.isna(x) else str(x) for x in column], type=pa.string())
+            arrays.append(array)
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def openWriter(self):
+        '''
+        Open the output file once the column types are known and write the
+        chunks kept until then.
+        '''
+        self.schema = pa.schema([pa.field(column, self.types.get(column, pa.string()))
+                                 for column in self.columns])
+        if self.format == 'feather':
+            self.writer = pa.ipc.new_file(self.outfile, self.schema)
+        else:
+            self.writer = pq.ParquetWriter(self.outfile, self.schema)
+        for df in self.pending:
+            self.writer.write_table(self.castTable(df))
+        self.pending = []
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            df = df.reindex(columns=self.columns)
+        if self.format == 'txt':
+            df.to_csv(self.outfile, index=False, sep='\t', encoding='utf-8',
+                      mode='w' if self.first else 'a', header=self.first)
+        else:
+            df = arrowSafe(df, categories=False)
+            if self.writer is None:
+                for column in self.columns:
+                    if column not in self.types and df[column].notna().any():
+                        self.types[column] = pa.array(df[column], from_pandas=True).type
+                self.pending.append(df)
+                if (len(self.types) == len(self.columns)
+                    or sum(len(df) for df in self.pending) >= self.BUFFER_ROWS):
+                    self.openWriter()
+            else:
+                self.writer.write_table(self.castTable(df))
+        self.first = False
+
+    def close(self):
+        if self.writer is None and self.pending:
+            self.openWriter()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
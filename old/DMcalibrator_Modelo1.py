@@ -22,6 +22,8 @@ import math
 import pandas as pd
 from scipy.special import erfinv
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from MassCache import getMassTable, neutralMass, chargeMZ
 pd.options.mode.chained_assignment = None  # default='warn'
 
 # os.chdir(r"C:\Users\Andrea\Desktop\SHIFTS-4")
@@ -55,35 +57,16 @@ def getTheoMZ(df, mzcolumn, zcolumn, seqcolumn):
     '''    
     Calculate theoretical MZ using the PSM sequence.
     '''
-    AAs = dict(mass_config._sections['Aminoacids'])
-    MODs = dict(mass_config._sections['Fixed Modifications'])
+    mass_table, term_mass = getMassTable(mass_config)
     m_proton = mass_config.getfloat('Masses', 'm_proton')
-    m_hydrogen = mass_config.getfloat('Masses', 'm_hydrogen')
-    m_oxygen = mass_config.getfloat('Masses', 'm_oxygen')
     if 'theo_mz' not in df:
         df.insert(df.columns.get_loc(mzcolumn)+1, 'theo_mz', np.nan)
     if 'theo_mh' not in df:
         df.insert(df.columns.get_loc('theo_mz'), 'theo_mh', np.nan)
     
-    def _PSMtoMZ(sequence, charge):
-        total_aas = 2*m_hydrogen + m_oxygen
-        total_aas += charge*m_proton
-        total_aas += float(MODs['nt']) + float(MODs['ct'])
-        for aa in sequence:
-            if aa.lower() in AAs:
-                total_aas += float(AAs[aa.lower()])
-            #else: # aminoacid not in list (ask for user input?)
-                # TODO
-            if aa.lower() in MODs:
-                total_aas += float(MODs[aa.lower()])
-        MH = total_aas - (charge-1)*m_proton
-        #MZ = (total_aas + int(charge)*m_proton) / int(charge)
-        MZ = total_aas / int(charge)
-        return MZ, MH
-    
-    df['theo_mz'] = df.apply(lambda x: _PSMtoMZ(x[seqcolumn], x[zcolumn])[0], axis = 1)
-    df['theo_mh'] = df.apply(lambda x: _PSMtoMZ(x[seqcolumn], x[zcolumn])[1], axis = 1)
-    #df['theo_mh'] = df.apply(lambda x: (x['theo_mz'] * x[zcolumn]) - (m_proton * (x[zcolumn]-1)), axis = 1)
+    # Neutral mass is calculated once per unique sequence
+    neutral_mass = neutralMass(df[seqcolumn].astype(str), mass_table, term_mass, {})
+    df['theo_mz'], df['theo_mh'] = chargeMZ(neutral_mass, df[zcolumn], m_proton)
     return df
 
 def getErrors(df, mzcolumn, calibrated):
@@ -160,7 +143,7 @@ def getSysError(df_filtered, calibrated):
     
     if calibrated:
         phi = math.sqrt(2) * erfinv(0.5)
-        mad = df_filtered['cal_ppm'].mad()
+        mad = (df_filtered['cal_ppm'] - df_filtered['cal_ppm'].mean()).abs().mean() # mean absolute deviation
         avg_ppm_error = (mad / phi) 
         logging.info("Systematic error after calibration: " + "{:.4e}".format(sys_error))
         logging.info("StdDevMAD_ppm: " + "{:.4e}".format(avg_ppm_error))
@@ -0,0 +1,84 @@
+import configparser
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from MassCache import getMassTable, neutralMass, residueTable, seqMass, chargeMZ, readMassCache, writeMassCache, massKey
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'MassMod.ini')
+
+
+@pytest.fixture
+def mass_config():
+    mass_config = configparser.ConfigParser(inline_comment_prefixes='#')
+    mass_config.read(CONFIG)
+    return mass_config
+
+
+def old_neutral_mass(sequence, mass_config):
+    # residue by residue, as DMcalibrator.getTheoMZ did
+    AAs = dict(mass_config._sections['Aminoacids'])
+    MODs = dict(mass_config._sections['Fixed Modifications'])
+    total = 2*mass_config.getfloat('Masses', 'm_hydrogen') + mass_config.getfloat('Masses', 'm_oxygen')
+    total += float(MODs['nt']) + float(MODs['ct'])
+    for aa in sequence:
+        if aa.lower() in AAs:
+            total += float(AAs[aa.lower()])
+        if aa.lower() in MODs:
+            total += float(MODs[aa.lower()])
+    return total
+
+
+def test_neutral_mass(mass_config):
+    rng = np.random.default_rng(0)
+    residues = np.array(list('ARNDCEQGHILKMFPSTUWYVOZ'))
+    sequences = [''.join(rng.choice(residues, rng.integers(5, 40))) for i in range(500)]
+    sequences += sequences[:100] + ['peptidek', 'PEPTIDEK']
+    mass_table, term_mass = getMassTable(mass_config)
+    cache = {}
+    mass = neutralMass(sequences, mass_table, term_mass, cache)
+    expected = [old_neutral_mass(seq, mass_config) for seq in sequences]
+    np.testing.assert_allclose(mass, expected, rtol=1e-12)
+    assert len(cache) == len(set(sequences))
+    assert mass[-1] == mass[-2]
+    # masses in the cache are reused
+    cache['PEPTIDEK'] = 0.0
+    assert neutralMass(['PEPTIDEK'], mass_table, term_mass, cache)[0] == 0.0
+
+
+def test_unknown_residues(mass_config, caplog):
+    # unknown residues count as 0 with a warning, as in DMcalibrator.getTheoMZ
+    mass_table, term_mass = getMassTable(mass_config)
+    with caplog.at_level(logging.INFO):
+        mass = neutralMass(['PEPXIDEK', 'PEPIDEK', 'BPEPIDEKX'], mass_table, term_mass, {})
+    np.testing.assert_allclose(mass, [old_neutral_mass(seq, mass_config) for seq in ['PEPXIDEK', 'PEPIDEK', 'BPEPIDEKX']],
+                               rtol=1e-12)
+    assert mass[0] == mass[1]
+    assert 'Unknown residues in sequences: B, X' in caplog.text
+    # strict mode, as TrunkSolver uses it
+    with pytest.raises(KeyError):
+        neutralMass(['PEPXIDEK'], mass_table, term_mass, {}, strict=True)
+    with pytest.raises(KeyError):
+        seqMass(['AC'], residueTable({'A': 71.037114}), strict=True)
+
+
+def test_residue_table():
+    mass_table = residueTable({'A': 71.037114, 'C': 103.009185, 'c': 160.030649})
+    np.testing.assert_allclose(seqMass(['AC', 'A', '', 'cA'], mass_table),
+                               [174.046299, 71.037114, 0.0, 231.067763])
+
+
+def test_charge_mz():
+    MZ, MH = chargeMZ(np.array([1000.0, 1000.0]), np.array([1, 2]), 1.007276)
+    np.testing.assert_allclose(MZ, [1001.007276, 501.007276])
+    np.testing.assert_allclose(MH, [1001.007276, 1001.007276])
+
+
+def test_mass_cache_file(tmp_path, mass_config):
+    cachefile = str(tmp_path / 'masses.tsv')
+    cache = {'PEPTIDEK': 0.1 + 0.2, 'NA': 1225.5}
+    writeMassCache(cachefile, massKey(mass_config), cache)
+    assert readMassCache(cachefile, massKey(mass_config)) == cache
+    assert readMassCache(cachefile, 'other') == {}
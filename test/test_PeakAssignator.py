@@ -0,0 +1,39 @@
+import numpy as np
+
+from PeakAssignator import closest_peak, find_orphans, parallel_closest_peak
+
+
+def test_closest_peak():
+    rng = np.random.default_rng(0)
+    apex_list = list(np.round(rng.uniform(-50, 500, 200), 3)) + [0.984, 0.984, 15.9949]
+    delta_MH = np.concatenate([rng.uniform(-60, 510, 5000), apex_list, [0.5*(0.984 + 15.9949)]])
+    index = closest_peak(apex_list, delta_MH)
+    # the first of the closest apexes in the list, as min(apex_list, key=...) did
+    expected = [min(apex_list, key=lambda x: abs(x - dm)) for dm in delta_MH]
+    np.testing.assert_array_equal(np.asarray(apex_list)[index], expected)
+    assert all(apex_list.index(apex_list[i]) == i for i in index)
+
+
+def test_closest_peak_missing():
+    index = closest_peak([1.0, 2.0], [np.nan, 1.9])
+    assert index.tolist() == [0, 1]
+
+
+def test_find_orphans():
+    theo_mass = np.array([1000.0, 1000.0, 2000.0])
+    peak = np.array([15.9949, 15.9949, 0.0])
+    delta_MH = np.array([15.9949, 16.0949, 0.01])
+    ID, distance_ppm = find_orphans('ppm', 20, theo_mass, peak, delta_MH, 'PEAK', 'ORPHAN')
+    assert ID.tolist() == ['PEAK', 'ORPHAN', 'PEAK']
+    expected = [abs(p - dm) / (t + p) * 1e6 for t, p, dm in zip(theo_mass, peak, delta_MH)]
+    np.testing.assert_allclose(distance_ppm, expected)
+    # tolerance in Da, one value for each PSM
+    ID, distance_ppm = find_orphans('da', np.array([0.05, 0.2, 0.005]), theo_mass, peak, delta_MH, 'PEAK', 'ORPHAN')
+    assert ID.tolist() == ['PEAK', 'PEAK', 'ORPHAN']
+
+
+def test_parallel_closest_peak():
+    rng = np.random.default_rng(1)
+    apex_list = list(np.round(rng.uniform(-50, 500, 100), 3))
+    delta_MH = np.concatenate([rng.uniform(-60, 510, 10001), [np.nan]])
+    np.testing.assert_array_equal(parallel_closest_peak(apex_list, delta_MH, 3), closest_peak(apex_list, delta_MH))
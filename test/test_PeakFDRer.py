@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from PeakFDRer import get_FDR, make_bins, make_groups, label_bins
+
+
+def old_ranks(df, keys, prefix, score_column='xcorr'):
+    # one group at a time, sorting by score and label, as the first PeakFDRer did
+    rank_T = pd.Series(-1, index=df.index)
+    rank_D = pd.Series(-1, index=df.index)
+    for key, group in df.groupby(keys, observed=True, dropna=False):
+        group = group.sort_values(by=[score_column, 'Label'], ascending=False)
+        rank_T[group.index] = (group['Label'] == 'Target').cumsum()
+        rank_D[group.index] = (group['Label'] == 'Decoy').cumsum()
+    return rank_T.rename(prefix + '_Rank_T'), rank_D.rename(prefix + '_Rank_D')
+
+
+@pytest.fixture
+def psms():
+    rng = np.random.default_rng(0)
+    n = 3000
+    apexes = np.array([-17.02655, 0.0, 0.984, 15.9949, 79.96633, 101.5])
+    closest = rng.choice(apexes, n)
+    df = pd.DataFrame({'xcorr': rng.permutation(n) / 1000, # no ties
+                       'xcorr_closest': rng.permutation(n) / 1000,
+                       'Label': rng.choice(['Target', 'Decoy'], n, p=[0.8, 0.2]),
+                       'Filename': rng.choice(['a.txt', 'b.txt', 'c.txt'], n),
+                       'ClosestPeak': closest,
+                       'Peak': rng.choice(['PEAK', 'ORPHAN'], n, p=[0.7, 0.3]),
+                       'cal_dm_mh': closest + rng.normal(0, 0.3, n)})
+    groups = pd.DataFrame({'Experiment': ['exp1', 'exp1', 'exp2'], 'Filename': ['a.txt', 'b.txt', 'c.txt']})
+    df = make_groups(df, groups)
+    df['LocalBin'] = make_bins(df['cal_dm_mh'])
+    return df
+
+
+def test_get_FDR(psms):
+    df = get_FDR(psms.copy(), 'xcorr', 'PEAK', 'Peak', 'ClosestPeak', 'cal_dm_mh', 4, 1, 0)
+    region = psms['cal_dm_mh'] >= 4
+    for keys, prefix in [(['Experiment', region], 'Global'), (['Experiment', 'LocalBin'], 'Local')]:
+        rank_T, rank_D = old_ranks(psms, keys, prefix)
+        np.testing.assert_array_equal(df[prefix + '_Rank_T'], rank_T)
+        np.testing.assert_array_equal(df[prefix + '_Rank_D'], rank_D)
+        np.testing.assert_array_equal(df[prefix + 'FDR'], rank_D / rank_T)
+    in_peak = psms['Peak'] == 'PEAK'
+    rank_T, rank_D = old_ranks(psms[in_peak], ['Experiment', 'LocalBin', 'ClosestPeak'], 'Peak')
+    np.testing.assert_array_equal(df.loc[in_peak, 'Peak_Rank_T'], rank_T)
+    np.testing.assert_array_equal(df.loc[in_peak, 'Peak_Rank_D'], rank_D)
+    np.testing.assert_array_equal(df.loc[in_peak, 'PeakFDR'], rank_D / rank_T)
+    assert (df.loc[~in_peak, 'PeakFDR'] == 100).all()
+    assert (df.loc[~in_peak, 'Peak_Rank_T'] == -1).all()
+    assert 'SpireFDR' not in df
+
+
+@pytest.mark.parametrize('spire_score_column', [None, 'xcorr_closest'])
+def test_get_FDR_spires(psms, spire_score_column):
+    in_spire = (psms['ClosestPeak'] == 15.9949).to_numpy()
+    df = get_FDR(psms.copy(), 'xcorr', 'PEAK', 'Peak', 'ClosestPeak', 'cal_dm_mh', 4, 1, 0, in_spire, spire_score_column)
+    in_spire = in_spire & (psms['Peak'] == 'PEAK')
+    rank_T, rank_D = old_ranks(psms[in_spire], ['Experiment', 'LocalBin', 'ClosestPeak'], 'Spire',
+                               spire_score_column or 'xcorr')
+    np.testing.assert_array_equal(df.loc[in_spire, 'Spire_Rank_T'], rank_T)
+    np.testing.assert_array_equal(df.loc[in_spire, 'Spire_Rank_D'], rank_D)
+    np.testing.assert_array_equal(df.loc[in_spire, 'SpireFDR'], rank_D / rank_T)
+    assert (df.loc[~in_spire, 'SpireFDR'] == 100).all()
+    # the other FDRs do not change
+    expected = get_FDR(psms.copy(), 'xcorr', 'PEAK', 'Peak', 'ClosestPeak', 'cal_dm_mh', 4, 1, 0)
+    for column in ['GlobalFDR', 'LocalFDR', 'PeakFDR']:
+        np.testing.assert_array_equal(df[column], expected[column])
+
+
+def test_get_FDR_parallel(psms):
+    # the units of work in n_workers processes give the same ranks as one sort
+    in_spire = (psms['ClosestPeak'] == 15.9949).to_numpy()
+    df = get_FDR(psms.copy(), 'xcorr', 'PEAK', 'Peak', 'ClosestPeak', 'cal_dm_mh', 4, 2, 100, in_spire)
+    expected = get_FDR(psms.copy(), 'xcorr', 'PEAK', 'Peak', 'ClosestPeak', 'cal_dm_mh', 4, 1, 0, in_spire)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_make_groups(psms):
+    df = psms.copy()
+    df.loc[:9, 'Filename'] = 'd.txt'
+    groups = pd.DataFrame({'Experiment': ['exp1', 'exp1', 'exp2'], 'Filename': ['a.txt', 'b.txt', 'c.txt']})
+    df = make_groups(df, groups)
+    expected = df['Filename'].map({'a.txt': 'exp1', 'b.txt': 'exp1', 'c.txt': 'exp2'}).fillna('N/A')
+    assert df['Experiment'].astype(str).tolist() == expected.tolist()
+
+
+def test_label_bins():
+    # labels of the first PeakFDRer, also for PSMs without deltamass
+    local_bin = label_bins(pd.Series(make_bins([0.2, -0.2, 0.7, -1.6, np.nan, 15.49])))
+    assert local_bin.tolist() == ['-0.5 to 0.5', '-0.5 to 0.5', '0.5 to 1.5', '-2.5 to -1.5', 'nan to nan', '14.5 to 15.5']
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import PeakModeller
+from TableIO import writeTable
+
+
+def test_file_histogram(tmp_path):
+    infile = tmp_path / 'exp1.txt'
+    writeTable(pd.DataFrame({'Scan': [1, 2, 3, 4], 'cal_dm_mh': [0.0015, 0.0025, 0.0031, np.nan]}), infile)
+    df, first_bin, counts = PeakModeller.file_histogram(str(infile), 0.002)
+    assert first_bin == 0
+    assert counts.tolist() == [1, 2]
+    assert df['bin'].cat.codes.tolist() == [0, 1, 1, -1]
+    assert df['bin'].cat.categories[1] == pd.Interval(0.002, 0.004, closed='right')
+
+
+def test_file_histogram_empty(tmp_path):
+    # file without deltamass values: bin column of the same type, all missing
+    infile = tmp_path / 'exp1.txt'
+    writeTable(pd.DataFrame({'Scan': [1, 2], 'cal_dm_mh': [np.nan, np.nan]}), infile)
+    df, first_bin, counts = PeakModeller.file_histogram(str(infile), 0.002)
+    assert isinstance(df['bin'].dtype, pd.CategoricalDtype)
+    assert isinstance(df['bin'].cat.categories.dtype, pd.IntervalDtype)
+    assert df['bin'].isna().all()
+    assert len(counts) == 0
+
+
+def test_merge_histograms():
+    first_bin, counts = PeakModeller.merge_histograms([(2, np.array([1, 2])), (0, np.zeros(0, dtype=np.int64)),
+                                                       (-1, np.array([5]))])
+    assert first_bin == -1
+    assert counts.tolist() == [5, 0, 0, 1, 2]
+    with pytest.raises(SystemExit):
+        PeakModeller.merge_histograms([(0, np.zeros(0, dtype=np.int64))])
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from TableIO import TableWriter, readTable, readTableChunks, writeTable, outName
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.mark.parametrize('ext', ['.txt', '.feather', '.parquet'])
+def test_write_read_table(tmp_path, ext):
+    df = pd.DataFrame({'Scan': [1, 2, 3], 'Cal_Delta_MH': [0.1 + 0.2, -15.994915, 1e-12],
+                       'Sequence': ['PEP[1.0]TIDE', 'AC[-2.5]K', 'M[0.0]']})
+    outfile = tmp_path / ('table' + ext)
+    writeTable(df, outfile)
+    pd.testing.assert_frame_equal(readTable(outfile), df, check_dtype=False)
+    pd.testing.assert_frame_equal(readTable(outfile, usecols=['Scan']), df[['Scan']], check_dtype=False)
+
+
+@pytest.mark.parametrize('ext', ['.txt', '.feather', '.parquet'])
+def test_read_chunks(tmp_path, ext):
+    df = pd.DataFrame({'Scan': np.arange(10), 'Cal_Delta_MH': np.linspace(-50, 50, 10)})
+    outfile = tmp_path / ('table' + ext)
+    writeTable(df, outfile)
+    chunks = list(readTableChunks(outfile, 3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df, check_dtype=False)
+
+
+def test_out_name():
+    assert outName('/data/exp1.txt', '_calibrated') == '/data/exp1_calibrated.txt'
+    assert outName('/data/exp1.txt', '_calibrated', 'feather') == '/data/exp1_calibrated.feather'
+    assert outName('/data/exp1.parquet', '_FDR') == '/data/exp1_FDR.parquet'
+
+
+@pytest.mark.parametrize('ext', ['.feather', '.parquet'])
+def test_writer_chunk_types(tmp_path, ext):
+    # column types of the later chunks are not those of the first one
+    chunks = [pd.DataFrame({'Empty': [np.nan, np.nan], 'Note': [None, None], 'Scan': [1, 2],
+                            'Label': ['Target', 'Decoy'], 'Score': [1.5, 2.5], 'Bin': pd.Categorical(['a', 'b'])}),
+              pd.DataFrame({'Empty': [3, np.nan], 'Note': ['x', None], 'Scan': [np.nan, 4.0],
+                            'Label': ['Target', None], 'Score': [1, 2], 'Bin': pd.Categorical(['c', 'a'])}),
+              pd.DataFrame({'Empty': [5, 6], 'Note': ['y', 'z'], 'Scan': [5, 6],
+                            'Label': ['Decoy', 'Target'], 'Score': [0.5, 3.0], 'Bin': pd.Categorical(['b', 'b'])})]
+    outfile = tmp_path / ('table' + ext)
+    writer = TableWriter(outfile)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    df = readTable(outfile)
+    np.testing.assert_array_equal(df['Empty'].to_numpy(), [np.nan, np.nan, 3, np.nan, 5, 6])
+    assert df['Note'].fillna('').tolist() == ['', '', 'x', '', 'y', 'z']
+    np.testing.assert_array_equal(df['Scan'].to_numpy(), [1, 2, np.nan, 4, 5, 6])
+    assert df['Label'].fillna('').tolist() == ['Target', 'Decoy', 'Target', '', 'Decoy', 'Target']
+    np.testing.assert_array_equal(df['Score'].to_numpy(), [1.5, 2.5, 1, 2, 0.5, 3.0])
+    assert df['Bin'].tolist() == ['a', 'b', 'c', 'a', 'b', 'b']
+
+
+@pytest.mark.parametrize('ext', ['.feather', '.parquet'])
+def test_writer_empty_column(tmp_path, ext):
+    # a column without values in any chunk is written as text
+    outfile = tmp_path / ('table' + ext)
+    writer = TableWriter(outfile)
+    writer.write(pd.DataFrame({'Scan': [1, 2], 'Empty': [np.nan, np.nan]}))
+    writer.write(pd.DataFrame({'Scan': [3], 'Empty': [np.nan]}))
+    writer.close()
+    df = readTable(outfile)
+    assert df['Scan'].tolist() == [1, 2, 3]
+    assert df['Empty'].isna().all()
+
+
+def test_writer_type_error(tmp_path):
+    writer = TableWriter(tmp_path / 'table.feather')
+    writer.write(pd.DataFrame({'Scan': [1, 2]}))
+    with pytest.raises(ValueError):
+        writer.write(pd.DataFrame({'Scan': ['a', 'b']}))
+    writer.close()
+    assert readTable(tmp_path / 'table.feather')['Scan'].tolist() == [1, 2]
+
+
+@pytest.mark.parametrize('ext', ['.txt', '.feather', '.parquet'])
+def test_writer_column_order(tmp_path, ext):
+    # two input files with the same columns in a different order
+    first = pd.DataFrame({'Scan': [1, 2], 'Label': ['Target', 'Decoy'], 'cal_dm_mh': [0.5, 15.99]})
+    second = pd.DataFrame({'cal_dm_mh': [-1.0, 79.97], 'Scan': [3, 4], 'Label': ['Decoy', 'Target']})
+    infiles = [tmp_path / 'first.txt', tmp_path / 'second.txt']
+    writeTable(first, infiles[0])
+    writeTable(second, infiles[1])
+    outfile = tmp_path / ('table' + ext)
+    writer = TableWriter(outfile)
+    for infile in infiles:
+        writer.write(readTable(infile))
+    writer.close()
+    expected = pd.concat([first, second[first.columns]], ignore_index=True)
+    pd.testing.assert_frame_equal(readTable(outfile), expected, check_dtype=False)
+
+
+def test_writer_missing_columns(tmp_path):
+    writer = TableWriter(tmp_path / 'table.txt')
+    writer.write(pd.DataFrame({'Scan': [1], 'Label': ['Target']}))
+    writer.write(pd.DataFrame({'Extra': ['x'], 'Scan': [2]}))
+    writer.close()
+    df = readTable(tmp_path / 'table.txt')
+    assert list(df.columns) == ['Scan', 'Label']
+    assert df['Scan'].tolist() == [1, 2]
+    assert df['Label'].isna().tolist() == [False, True]